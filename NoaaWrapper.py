@@ -1,20 +1,1413 @@
+import numpy as np
 import pandas as pd  
 import time as tm 
+import datetime as dt
+import asyncio
+import copy
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import queue
+import random
+import shutil
+import sqlite3
+import threading
+import uuid
+from array import array
+from typing import List, Optional
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
 import requests as req
+from requests.adapters import HTTPAdapter
+from email.utils import parsedate_to_datetime
+from urllib.parse import parse_qsl, quote, urlencode, urlsplit, urlunsplit
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    from scipy.spatial import cKDTree
+except ImportError:
+    cKDTree = None
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+
+# Largest page size the CDO api will return.
+MAX_LIMIT = 1000
+
+# Longest date range, in years, a single data request may span. 
+# Monthly and annual summaries allow ten years, everything else one.
+DATE_RANGE_YEARS = dict(GSOM = 10, GSOY = 10)
+
+# Days covered by one record of a dataset, used to estimate result sizes.
+RECORD_DAYS = dict(GSOM = 30.4, GSOY = 365.25)
+
+# Data types a station reports when none are asked for, for the same estimates.
+DEFAULT_DATATYPES = 5
+
+# Most station ids chained into a single data request.
+MAX_IDS_PER_REQUEST = 50
+
+EARTH_RADIUS_KM = 6371.0088
+
+# Factors turning raw values (no units requested) into metric units, 
+# by dataset and data type. GHCND stores these in tenths.
+RAW_SCALE = dict(GHCND = dict.fromkeys(['TMAX', 'TMIN', 'TAVG', 'TOBS', 'MNPN', 'MXPN', 
+                                        'PRCP', 'MDPR', 'EVAP', 'WESD', 'WESF', 'AWND', 
+                                        'WSF1', 'WSF2', 'WSF5', 'WSFG', 'WSFI', 'WSFM'], 0.1))
+
+# Names of the leading comma separated fields of a data record's attributes.
+ATTRIBUTE_FLAGS = ('measurement_flag', 'quality_flag', 'source_flag')
+
+
+class QuotaExceeded(Exception):
+    """Raised when the daily request quota of a RateLimiter is used up."""
+
+
+class RateLimiter(object):
+
+    def __init__(self, per_second = 5, per_day = 10000):
+        """
+        Token bucket shared by every request made with one api token.
+
+        NOAA allows 5 requests per second and 10,000 requests per day 
+        per token. Requests are let through as fast as the per second 
+        bucket allows and only block once it is empty. The daily 
+        counter resets at midnight UTC.
+        ------------------------------------------------------------------
+        per_second =    Size and refill rate of the per second bucket.
+                        Defaults to 5.
+        ------------------------------------------------------------------
+        per_day =       Daily request quota. Defaults to 10000.
+        """
+        self.per_second = per_second
+        self.per_day = per_day
+        self._tokens = float(per_second)
+        self._last = tm.monotonic()
+        self._day = tm.gmtime().tm_yday
+        self._used = 0
+        self._paused_until = 0
+        self._lock = threading.Lock()
+
+    @property
+    def remaining(self):
+        """Number of requests left in today's quota."""
+        with self._lock:
+            self._roll_day()
+            return self.per_day - self._used
+
+    def _roll_day(self):
+        day = tm.gmtime().tm_yday
+        if day != self._day:
+            self._day = day
+            self._used = 0
+
+    def _refill(self):
+        now = tm.monotonic()
+        self._tokens = min(self.per_second, 
+                           self._tokens + (now - self._last) * self.per_second)
+        self._last = now
+
+    def pause(self, seconds):
+        """Hold back every request for the next seconds, e.g. after a 429."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, tm.monotonic() + seconds)
+
+    def _reserve(self):
+        """Take a token and return 0, or return the seconds to wait for one."""
+        with self._lock:
+            self._roll_day()
+            if self._used >= self.per_day:
+                raise QuotaExceeded(f'Daily quota of {self.per_day} requests used up')
+            paused = self._paused_until - tm.monotonic()
+            if paused > 0:
+                return paused
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                self._used += 1
+                return 0
+            return (1 - self._tokens) / self.per_second
+
+    def acquire(self):
+        """
+        Block until a request may be sent and count it against the 
+        daily quota. Returns the seconds spent waiting. Raises 
+        QuotaExceeded if the quota is used up.
+        """
+        waited = 0
+        wait = self._reserve()
+        while wait:
+            tm.sleep(wait)
+            waited += wait
+            wait = self._reserve()
+        return waited
+
+    async def acquire_async(self):
+        """Same as acquire, but waits without blocking the event loop."""
+        waited = 0
+        wait = self._reserve()
+        while wait:
+            await asyncio.sleep(wait)
+            waited += wait
+            wait = self._reserve()
+        return waited
+
+
+class CircuitOpen(Exception):
+    """Raised while a RetryPolicy's circuit breaker is open."""
+
+
+class EmptyPage(Exception):
+    """Raised when a page inside a result set keeps coming back without results."""
+
+
+class RetryPolicy(object):
+
+    # Responses worth retrying; any other error status is fatal.
+    RETRY_STATUSES = frozenset([408, 429, 500, 502, 503, 504])
+
+    def __init__(self, max_retries = 3, backoff = 0.5, max_backoff = 60, 
+                 breaker_threshold = 10, breaker_cooldown = 60):
+        """
+        Decides when and how long to wait before retrying a request.
+
+        Connection errors, timeouts, undecodable bodies (NOAA's html 
+        error pages), empty bodies for pages inside a result set (which 
+        NOAA sends under load) and RETRY_STATUSES are retried with 
+        exponential backoff and full jitter, waiting at least as long as any 
+        Retry-After header asks. Every retry goes back through the rate 
+        limiter, and a 429 pauses the limiter for everyone sharing it. 
+        After breaker_threshold failures in a row the circuit opens and 
+        requests raise CircuitOpen for breaker_cooldown seconds.
+        ------------------------------------------------------------------
+        max_retries =       Retries per request. Defaults to 3.
+        ------------------------------------------------------------------
+        backoff =           Base delay in seconds. Defaults to 0.5.
+        ------------------------------------------------------------------
+        max_backoff =       Longest single delay. Defaults to 60.
+        ------------------------------------------------------------------
+        breaker_threshold = Consecutive failures that open the circuit. 
+                            Defaults to 10.
+        ------------------------------------------------------------------
+        breaker_cooldown =  Seconds the circuit stays open. Defaults to 60.
+        """
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self._failures = 0
+        self._open_until = 0
+        self._lock = threading.Lock()
+
+    def check(self):
+        """Raise CircuitOpen if the breaker is open."""
+        with self._lock:
+            if tm.monotonic() < self._open_until:
+                raise CircuitOpen(f'{self._failures} consecutive request failures, '
+                                  f'retry in {self._open_until - tm.monotonic():.0f}s')
+
+    def success(self):
+        with self._lock:
+            self._failures = 0
+
+    def failure(self):
+        with self._lock:
+            self._failures += 1
+            if self._failures >= self.breaker_threshold:
+                self._open_until = tm.monotonic() + self.breaker_cooldown
+
+    def delay(self, attempt, retry_after = None):
+        """Seconds to wait before retry number attempt + 1."""
+        wait = random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+        return max(wait, self._retry_after(retry_after))
+
+    @staticmethod
+    def _retry_after(value):
+        if not value:
+            return 0
+        try:
+            return float(value)
+        except ValueError:
+            pass
+        try:
+            return max(0, parsedate_to_datetime(value).timestamp() - tm.time())
+        except (TypeError, ValueError):
+            return 0
+
+
+def _split_url(url, params = None):
+    """
+    Merge the query string already on url with params, dropping None 
+    values. Returns the bare url and a list of (key, value) string 
+    pairs; list values become one pair per item, the way requests 
+    sends ampersand chained ids.
+    """
+    parts = urlsplit(url)
+    query = dict(parse_qsl(parts.query))
+    query.update({k: v for k, v in (params or {}).items() if v is not None})
+    pairs = []
+    for key, value in query.items():
+        for item in (value if isinstance(value, (list, tuple)) else [value]):
+            pairs.append((key, str(item)))
+    return urlunsplit(parts._replace(query = '')), pairs
+
+
+def _endpoint(url):
+    """Name of the api endpoint a url points at, e.g. 'stations'."""
+    path = urlsplit(url).path.rstrip('/').split('/')
+    return path[path.index('v2') + 1] if 'v2' in path[:-1] else path[-1]
+
+
+def _json_decoder(decoder = None):
+    """
+    Return a function decoding a response body (bytes) into python
+    objects. decoder is 'orjson', 'msgspec', 'json', a function, or
+    None for the fastest one installed. Every built in choice raises
+    a ValueError on bad input.
+    """
+    if callable(decoder):
+        return decoder
+    if decoder is None:
+        decoder = 'orjson' if orjson is not None else 'msgspec' if msgspec is not None else 'json'
+    if decoder == 'orjson':
+        if orjson is None:
+            raise ImportError('The orjson decoder requires orjson: pip install orjson')
+        return orjson.loads
+    if decoder == 'msgspec':
+        if msgspec is None:
+            raise ImportError('The msgspec decoder requires msgspec: pip install msgspec')
+        return msgspec.json.Decoder().decode
+    if decoder == 'json':
+        return json.loads
+    raise ValueError(f"decoder must be 'orjson', 'msgspec', 'json' or a function, not {decoder!r}")
+
+
+if msgspec is not None:
+
+    class DataRecord(msgspec.Struct):
+        """One observation of a data() page."""
+        date: Optional[str] = None
+        datatype: Optional[str] = None
+        station: Optional[str] = None
+        attributes: Optional[str] = None
+        value: Optional[float] = None
+
+    class StationRecord(msgspec.Struct):
+        """One station of a stations() page."""
+        id: Optional[str] = None
+        name: Optional[str] = None
+        latitude: Optional[float] = None
+        longitude: Optional[float] = None
+        elevation: Optional[float] = None
+        elevationUnit: Optional[str] = None
+        mindate: Optional[str] = None
+        maxdate: Optional[str] = None
+        datacoverage: Optional[float] = None
+
+else:
+    DataRecord = StationRecord = None
+
+_PAGE_DECODERS = {}
+
+
+def _page_decoder(record):
+    """
+    Return a function decoding a page of results straight into record
+    structs, with no intermediate dict per record. The page itself
+    comes back as the usual {'metadata': ..., 'results': [...]} dict.
+    """
+    if record not in _PAGE_DECODERS:
+        page = msgspec.defstruct(record.__name__ + 'Page',
+                                 [('metadata', Optional[dict], None),
+                                  ('results', List[record], [])])
+        decode = msgspec.json.Decoder(page).decode
+
+        def decoder(raw):
+            body = decode(raw)
+            if body.metadata is None:
+                # NOAA answers a query with no matches with an empty {}
+                return dict(results = body.results) if body.results else {}
+            return dict(metadata = body.metadata, results = body.results)
+
+        _PAGE_DECODERS[record] = decoder
+    return _PAGE_DECODERS[record]
+
+
+class Metrics(object):
+
+    # Upper bounds, in seconds, of the request latency histogram buckets.
+    BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self, callbacks = None):
+        """
+        Collects one event per api call made through Noaa._get.
+
+        Each event is a dict with the endpoint, a params hash, latency 
+        (seconds), bytes, http status, retries, cache ('hit', 'miss', 
+        'checkpoint', 'coalesced' or None), seconds waited on the rate 
+        limiter, the error name if it failed and the quota left. Events 
+        are folded into counters and a latency histogram per endpoint, 
+        and passed to every callback, e.g. to forward them to a logging 
+        or statsd client. prometheus() renders the aggregates in the 
+        Prometheus text format.
+        ------------------------------------------------------------------
+        callbacks =     Functions called with every event dict.
+        """
+        self.callbacks = list(callbacks or [])
+        self.counters = {}
+        self.histograms = {}
+        self.quota_remaining = None
+        self._lock = threading.Lock()
+
+    def _inc(self, name, labels, amount = 1):
+        key = (name, tuple(sorted(labels.items())))
+        self.counters[key] = self.counters.get(key, 0) + amount
+
+    def record(self, event):
+        endpoint = event['endpoint']
+        with self._lock:
+            if event['cache'] is not None:
+                self._inc('noaa_cache_total', dict(endpoint = endpoint, result = event['cache']))
+            if event['cache'] not in ('hit', 'checkpoint', 'coalesced'):
+                status = event['status'] or 'error'
+                self._inc('noaa_requests_total', dict(endpoint = endpoint, status = str(status)))
+                self._inc('noaa_retries_total', dict(endpoint = endpoint), event['retries'])
+                self._inc('noaa_response_bytes_total', dict(endpoint = endpoint), event['bytes'])
+                self._inc('noaa_ratelimit_wait_seconds_total', dict(endpoint = endpoint), 
+                          event['waited'])
+                histogram = self.histograms.setdefault(endpoint, [0] * (len(self.BUCKETS) + 2))
+                for i, bound in enumerate(self.BUCKETS):
+                    if event['latency'] <= bound:
+                        histogram[i] += 1
+                histogram[-2] += event['latency']
+                histogram[-1] += 1
+            if event.get('quota_remaining') is not None:
+                self.quota_remaining = event['quota_remaining']
+        for callback in self.callbacks:
+            callback(event)
+
+    def snapshot(self):
+        """Counters, histograms and quota as plain dicts."""
+        with self._lock:
+            counters = {}
+            for (name, labels), value in self.counters.items():
+                counters.setdefault(name, {})[labels] = value
+            histograms = {endpoint: dict(buckets = dict(zip(self.BUCKETS, counts[:-2])), 
+                                         sum = counts[-2], count = counts[-1])
+                          for endpoint, counts in self.histograms.items()}
+            return dict(counters = counters, histograms = histograms, 
+                        quota_remaining = self.quota_remaining)
+
+    def prometheus(self):
+        """The aggregates in the Prometheus text exposition format."""
+        def fmt(labels):
+            return '{' + ','.join(f'{key}="{value}"' for key, value in labels) + '}'
+
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f'{name}{fmt(labels)} {value}')
+            for endpoint, counts in sorted(self.histograms.items()):
+                for bound, count in zip(self.BUCKETS, counts):
+                    lines.append(f'noaa_request_seconds_bucket'
+                                 f'{fmt([("endpoint", endpoint), ("le", bound)])} {count}')
+                lines.append(f'noaa_request_seconds_bucket'
+                             f'{fmt([("endpoint", endpoint), ("le", "+Inf")])} {counts[-1]}')
+                lines.append(f'noaa_request_seconds_sum{fmt([("endpoint", endpoint)])} {counts[-2]}')
+                lines.append(f'noaa_request_seconds_count{fmt([("endpoint", endpoint)])} {counts[-1]}')
+            if self.quota_remaining is not None:
+                lines.append(f'noaa_quota_remaining {self.quota_remaining}')
+        return '\n'.join(lines) + '\n'
+
+
+class ResponseCache(object):
+
+    # Seconds a cached response stays fresh, by endpoint. Metadata 
+    # hardly changes; data and stations grow as new observations land.
+    DEFAULT_TTLS = dict(datasets = 7 * 86400, datacategories = 7 * 86400, 
+                        datatypes = 7 * 86400, locationcategories = 7 * 86400,
+                        locations = 7 * 86400, stations = 86400, data = 86400)
+
+    def __init__(self, path = 'noaa_cache.sqlite', ttls = None, 
+                 default_ttl = 86400, max_bytes = 512 * 2**20):
+        """
+        SQLite backed cache of decoded api responses.
+
+        Responses are keyed on the normalized url and query params; the 
+        token is sent as a header so it is never part of the key. The 
+        file can be shared by several processes. Once the stored bodies 
+        exceed max_bytes the least recently used entries are evicted.
+        ------------------------------------------------------------------
+        path =          Location of the SQLite file. Use ':memory:' for 
+                        a cache private to this process.
+        ------------------------------------------------------------------
+        ttls =          dict of endpoint name (datasets, datatypes, 
+                        stations, data ...) to seconds. Merged over 
+                        DEFAULT_TTLS. A ttl of None never expires.
+        ------------------------------------------------------------------
+        default_ttl =   Seconds for endpoints not in ttls.
+        ------------------------------------------------------------------
+        max_bytes =     Size bound of the stored bodies. Defaults to 512MB.
+        """
+        self.ttls = dict(self.DEFAULT_TTLS, **(ttls or {}))
+        self.default_ttl = default_ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout = 30, check_same_thread = False, 
+                                   isolation_level = None)
+        if path != ':memory:':
+            self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute('CREATE TABLE IF NOT EXISTS responses ('
+                         'key TEXT PRIMARY KEY, body BLOB, size INTEGER, '
+                         'expires REAL, accessed REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_accessed '
+                         'ON responses (accessed)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS responses_expires '
+                         'ON responses (expires)')
+        # Running total of the stored bytes, kept by triggers so every 
+        # process sharing the file sees the same figure without summing 
+        # the table on each write. Seeded from the table for files 
+        # written before it existed.
+        self._db.execute('CREATE TABLE IF NOT EXISTS usage ('
+                         'id INTEGER PRIMARY KEY CHECK (id = 0), bytes INTEGER)')
+        self._db.execute('INSERT OR IGNORE INTO usage '
+                         'SELECT 0, COALESCE(SUM(size), 0) FROM responses')
+        self._db.execute('CREATE TRIGGER IF NOT EXISTS responses_insert AFTER INSERT ON responses '
+                         'BEGIN UPDATE usage SET bytes = bytes + NEW.size; END')
+        self._db.execute('CREATE TRIGGER IF NOT EXISTS responses_update AFTER UPDATE OF size ON responses '
+                         'BEGIN UPDATE usage SET bytes = bytes + NEW.size - OLD.size; END')
+        self._db.execute('CREATE TRIGGER IF NOT EXISTS responses_delete AFTER DELETE ON responses '
+                         'BEGIN UPDATE usage SET bytes = bytes - OLD.size; END')
+
+    @staticmethod
+    def key(url, params = None):
+        url, query = _split_url(url, params)
+        return url + '?' + urlencode(sorted(query))
+
+    def _ttl(self, url):
+        return self.ttls.get(_endpoint(url), self.default_ttl)
+
+    def get(self, url, params = None):
+        """Return the cached body for a request, or None."""
+        key = self.key(url, params)
+        now = tm.time()
+        with self._lock:
+            row = self._db.execute('SELECT body, expires FROM responses WHERE key = ?', 
+                                   (key,)).fetchone()
+            if row is None or (row[1] is not None and row[1] < now):
+                self.misses += 1
+                return None
+            self._db.execute('UPDATE responses SET accessed = ? WHERE key = ?', (now, key))
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, url, params, body):
+        key = self.key(url, params)
+        blob = json.dumps(body).encode()
+        ttl = self._ttl(url)
+        now = tm.time()
+        expires = None if ttl is None else now + ttl
+        with self._lock:
+            # An upsert rather than INSERT OR REPLACE, whose implicit 
+            # delete would skip the usage trigger.
+            self._db.execute('INSERT INTO responses VALUES (?, ?, ?, ?, ?) '
+                             'ON CONFLICT (key) DO UPDATE SET body = excluded.body, '
+                             'size = excluded.size, expires = excluded.expires, '
+                             'accessed = excluded.accessed',
+                             (key, blob, len(blob), expires, now))
+            self._evict()
+
+    def _size(self):
+        return self._db.execute('SELECT bytes FROM usage').fetchone()[0]
+
+    def _evict(self):
+        # Expired entries are already invisible to get(), so neither they 
+        # nor the least recently used ones are swept until the bound is hit.
+        if self._size() <= self.max_bytes:
+            return
+        self._db.execute('DELETE FROM responses WHERE expires < ?', (tm.time(),))
+        size = self._size()
+        if size <= self.max_bytes:
+            return
+        rows = self._db.execute('SELECT key, size FROM responses ORDER BY accessed')
+        stale = []
+        for key, nbytes in rows:
+            if size <= self.max_bytes:
+                break
+            stale.append((key,))
+            size -= nbytes
+        self._db.executemany('DELETE FROM responses WHERE key = ?', stale)
+
+    def clear(self):
+        with self._lock:
+            self._db.execute('DELETE FROM responses')
+        self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute('SELECT COUNT(*) FROM responses').fetchone()[0]
+            size = self._size()
+        return dict(hits = self.hits, misses = self.misses, entries = entries, bytes = size)
+
+    def close(self):
+        self._db.close()
+
+
+class Checkpoint(object):
+
+    def __init__(self, checkpoint_id, directory = '.noaa_checkpoints'):
+        """
+        On disk record of the pages fetched by one long running call.
+
+        Every response is written to directory/checkpoint_id as it 
+        arrives, keyed on the normalized url and params, so rerunning 
+        the same call with the same checkpoint only requests the pages 
+        (offsets and date windows) that are missing. Files are written 
+        atomically; call clear() once the results are safely stored.
+        """
+        self.checkpoint_id = checkpoint_id
+        self.path = os.path.join(directory, checkpoint_id)
+        os.makedirs(self.path, exist_ok = True)
+
+    def _file(self, url, params):
+        key = ResponseCache.key(url, params)
+        return os.path.join(self.path, hashlib.sha1(key.encode()).hexdigest() + '.json')
+
+    def get(self, url, params = None):
+        """Return the saved body for a request, or None."""
+        try:
+            with open(self._file(url, params)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def set(self, url, params, body):
+        path = self._file(url, params)
+        tmp = f'{path}.{os.getpid()}.{threading.get_ident()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(body, f)
+        os.replace(tmp, path)
+
+    def __len__(self):
+        return sum(name.endswith('.json') for name in os.listdir(self.path))
+
+    def clear(self):
+        shutil.rmtree(self.path, ignore_errors = True)
+
+
+class _CodedColumn(object):
+    """Dictionary encoded column: each distinct value is stored once."""
+
+    def __init__(self):
+        self.codes = array('l')
+        self.values = {}
+
+    def extend(self, values):
+        lookup = self.values
+        self.codes.extend([-1 if value is None else lookup.setdefault(value, len(lookup)) 
+                           for value in values])
+
+    def merge(self, other):
+        # Recode the other column's codes into this column's dictionary
+        lookup = self.values
+        recode = np.array([lookup.setdefault(value, len(lookup)) for value in other.values] + [-1],
+                          dtype = f'i{self.codes.itemsize}')
+        self.codes.frombytes(recode[np.frombuffer(other.codes, dtype = recode.dtype)].tobytes())
+
+    def decoded(self):
+        """The values, in row order, with None for missing ones."""
+        values = list(self.values) + [None]
+        return map(values.__getitem__, self.codes)
+
+    def categorical(self):
+        codes = np.frombuffer(self.codes, dtype = f'i{self.codes.itemsize}')
+        return pd.Categorical.from_codes(codes, categories = list(self.values))
+
+    def dates(self):
+        try:
+            uniques = pd.to_datetime(list(self.values)).values
+        except (ValueError, pd.errors.OutOfBoundsDatetime):
+            # e.g. station mindates before 1677; keep the strings
+            return np.array(list(self.values) + [None], dtype = object)[self.codes]
+        # code -1 (missing) picks the trailing NaT
+        return np.append(uniques, np.datetime64('NaT'))[self.codes]
+
+
+class _FloatColumn(object):
+
+    def __init__(self):
+        self.values = array('d')
+
+    def extend(self, values):
+        self.values.extend([np.nan if value is None else value for value in values])
+
+    def merge(self, other):
+        self.values.extend(other.values)
+
+    def decoded(self):
+        return (None if value != value else value for value in self.values)
+
+    def numbers(self):
+        return np.frombuffer(self.values, dtype = np.float64)
+
+
+def _factorize(column, sort = False):
+    """
+    Integer codes (-1 for missing) and distinct values of a column, 
+    read straight off a categorical's codes when it is one.
+    """
+    if not isinstance(column.dtype, pd.CategoricalDtype):
+        return pd.factorize(np.asarray(column, dtype = object), sort = sort)
+    codes = column.cat.codes.to_numpy()
+    values = np.asarray(column.cat.categories, dtype = object)
+    if sort:
+        order = np.argsort(values)
+        rank = np.empty(len(order) + 1, dtype = codes.dtype)
+        rank[order] = np.arange(len(order))
+        rank[-1] = -1
+        codes, values = rank[codes], values[order]
+    return codes, values
+
+
+class FrameBuilder(object):
+
+    DATES = ('date', 'mindate', 'maxdate')
+    FLOATS = ('value', 'latitude', 'longitude', 'elevation', 'datacoverage', 'distance')
+    CATEGORIES = ('station', 'datatype', 'attributes', 'elevationUnit')
+
+    def __init__(self):
+        """
+        Builds a DataFrame from pages of results, one page at a time.
+
+        Each page is appended to typed column buffers: dictionary 
+        encoded codes for station, datatype and attributes (and the 
+        date columns), float arrays for numeric fields and plain lists 
+        for everything else. build() turns them into categorical, 
+        datetime64 and float64 columns without going through a list 
+        of per record dicts. Pages may be lists of dicts or of 
+        DataRecord / StationRecord structs.
+        """
+        self._columns = {}
+        self._rows = 0
+
+    def _column(self, key):
+        if key in self.FLOATS:
+            return _FloatColumn()
+        if key in self.DATES or key in self.CATEGORIES:
+            return _CodedColumn()
+        return []
+
+    def add(self, results):
+        if isinstance(results, Records):
+            return self._merge(results._builder)
+        if not results:
+            return
+        fields = getattr(results[0], '__struct_fields__', None)
+        if fields is not None:
+            # DataRecord / StationRecord structs: read the attributes
+            keys = dict.fromkeys(fields)
+            values = lambda key: [getattr(record, key) for record in results]
+        else:
+            keys = dict.fromkeys(key for record in results for key in record)
+            values = lambda key: [record.get(key) for record in results]
+        for key in keys:
+            if key not in self._columns:
+                column = self._columns[key] = self._column(key)
+                column.extend([None] * self._rows)
+        for key, column in self._columns.items():
+            if key in keys:
+                column.extend(values(key))
+            else:
+                column.extend([None] * len(results))
+        self._rows += len(results)
+
+    def _merge(self, other):
+        for key, column in other._columns.items():
+            if key not in self._columns:
+                self._columns[key] = self._column(key)
+                self._columns[key].extend([None] * self._rows)
+        for key, column in self._columns.items():
+            if key in other._columns:
+                if isinstance(column, list):
+                    column.extend(other._columns[key])
+                else:
+                    column.merge(other._columns[key])
+            else:
+                column.extend([None] * other._rows)
+        self._rows += other._rows
+
+    def __len__(self):
+        return self._rows
+
+    def build(self):
+        columns = {}
+        for key, column in self._columns.items():
+            if isinstance(column, _FloatColumn):
+                columns[key] = column.numbers()
+            elif key in self.DATES:
+                columns[key] = column.dates()
+            elif isinstance(column, _CodedColumn):
+                columns[key] = column.categorical()
+            else:
+                columns[key] = column
+        return pd.DataFrame(columns, index = pd.RangeIndex(self._rows), copy = False)
+
+    @staticmethod
+    def wide(frame, scale = None):
+        """
+        Pivot a long data() frame into a wide one: a DatetimeIndex of 
+        dates by (field, station, datatype) columns, where field is 
+        'value' or one of ATTRIBUTE_FLAGS, so frame['value'] is the 
+        date x (station, datatype) table. Flags are categoricals 
+        parsed from the distinct attributes strings only and spread 
+        over the rows through their codes. scale maps data types to 
+        factors the values are multiplied by. Duplicate (date, station, 
+        datatype) rows keep the last value; rows missing a date, 
+        station or datatype are dropped.
+        """
+        date_codes, dates = pd.factorize(pd.to_datetime(frame['date']), sort = True)
+        station_codes, stations = _factorize(frame['station'], sort = True)
+        type_codes, types = _factorize(frame['datatype'], sort = True)
+        # Code -1 would index the last row or column when scattering
+        keep = (date_codes >= 0) & (station_codes >= 0) & (type_codes >= 0)
+        if keep.all():
+            keep = slice(None)
+        date_codes, station_codes, type_codes = \
+            date_codes[keep], station_codes[keep], type_codes[keep]
+        pair_codes, pairs = pd.factorize(station_codes * max(len(types), 1) + type_codes, 
+                                         sort = True)
+        shape = (len(dates), len(pairs))
+        index = pd.DatetimeIndex(dates, name = 'date')
+
+        values = frame['value'].to_numpy(dtype = np.float64, na_value = np.nan)[keep]
+        if scale:
+            factors = np.array([scale.get(t, 1.0) for t in types])
+            values = values * factors[type_codes]
+        table = np.full(shape, np.nan)
+        table[date_codes, pair_codes] = values
+        station_of = stations[pairs // max(len(types), 1)]
+        type_of = types[pairs % max(len(types), 1)]
+        parts = [pd.DataFrame(table, index = index, copy = False,
+                              columns = pd.MultiIndex.from_arrays(
+                                  [['value'] * len(pairs), station_of, type_of], 
+                                  names = ['field', 'station', 'datatype']))]
+
+        if 'attributes' in frame:
+            attribute_codes, attributes = _factorize(frame['attributes'])
+            attribute_codes = attribute_codes[keep]
+            fields = [str(attribute).split(',') for attribute in attributes]
+            for i, name in enumerate(ATTRIBUTE_FLAGS):
+                flag_codes, flags = pd.factorize(np.array(
+                    [field[i] if len(field) > i and field[i] else None for field in fields], 
+                    dtype = object))
+                # code -1 (no attributes) picks the trailing -1 (no flag)
+                row_codes = np.append(flag_codes, -1)[attribute_codes]
+                codes = np.full(shape, -1, dtype = row_codes.dtype)
+                codes[date_codes, pair_codes] = row_codes
+                dtype = pd.CategoricalDtype(flags)
+                columns = {(name, station, datatype): pd.Categorical.from_codes(codes[:, j], 
+                                                                               dtype = dtype)
+                           for j, (station, datatype) in enumerate(zip(station_of, type_of))}
+                parts.append(pd.DataFrame(columns, index = index))
+        wide = pd.concat(parts, axis = 1)
+        wide.columns.names = ['field', 'station', 'datatype']
+        return wide
+
+
+class Records(object):
+
+    def __init__(self, builder = None):
+        """
+        Read only, list like container of records held in a 
+        FrameBuilder's column buffers instead of one dict per record.
+
+        Repeated strings (station, datatype, attributes, dates) are 
+        stored once and referenced by integer codes, numbers sit in 
+        float arrays and no key strings are repeated, which takes a 
+        large data() pull to a fraction of the memory of a list of 
+        dicts. Indexing and iterating build the dicts on the fly; 
+        missing values are left out of them and numbers come back as 
+        floats. to_frame() and to_json() convert without that detour 
+        where they can. Returned by data() and stations() when 
+        compact is True.
+        """
+        self._builder = builder if builder is not None else FrameBuilder()
+        self._categories = {}
+
+    @classmethod
+    def from_pages(cls, pages):
+        builder = FrameBuilder()
+        for results in pages:
+            builder.add(results)
+        return cls(builder)
+
+    @property
+    def columns(self):
+        return list(self._builder._columns)
+
+    def __len__(self):
+        return len(self._builder)
+
+    def __iter__(self):
+        keys = self.columns
+        columns = [column.decoded() if not isinstance(column, list) else iter(column)
+                   for column in self._builder._columns.values()]
+        for row in zip(*columns):
+            yield {key: value for key, value in zip(keys, row) if value is not None}
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('Records index out of range')
+        record = {}
+        for key, column in self._builder._columns.items():
+            if isinstance(column, _CodedColumn):
+                if key not in self._categories:
+                    self._categories[key] = list(column.values) + [None]
+                value = self._categories[key][column.codes[index]]
+            elif isinstance(column, _FloatColumn):
+                value = column.values[index]
+                value = None if value != value else value
+            else:
+                value = column[index]
+            if value is not None:
+                record[key] = value
+        return record
+
+    def __eq__(self, other):
+        if isinstance(other, (Records, list)):
+            return len(self) == len(other) and all(a == b for a, b in zip(self, other))
+        return NotImplemented
+
+    def __repr__(self):
+        return f'<Records: {len(self)} rows, columns {self.columns}>'
+
+    def to_list(self):
+        """The records as a list of dicts."""
+        return list(self)
+
+    def to_frame(self):
+        """The records as a DataFrame, as df = True would return."""
+        return self._builder.build()
+
+    def to_json(self):
+        """The records as a json array string."""
+        if orjson is not None:
+            return orjson.dumps(self.to_list()).decode()
+        return json.dumps(self.to_list())
+
+
+class SyncState(object):
+
+    def __init__(self, path = 'noaa_sync.sqlite'):
+        """
+        SQLite store of the newest observation date ingested per 
+        dataset, station and data type, used by Noaa.sync().
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout = 30, check_same_thread = False, 
+                                   isolation_level = None)
+        self._db.execute('CREATE TABLE IF NOT EXISTS watermarks ('
+                         'dataset TEXT, station TEXT, datatype TEXT, date TEXT, '
+                         'PRIMARY KEY (dataset, station, datatype))')
+
+    def watermark(self, dataset_id, station_id, datatype_ids = None):
+        """
+        Date (YYYY-MM-DD) up to which station_id is ingested, or None. 
+        With datatype_ids it is the oldest of their watermarks, so no 
+        data type is skipped; without, the newest of any data type.
+        """
+        with self._lock:
+            rows = dict(self._db.execute(
+                'SELECT datatype, date FROM watermarks WHERE dataset = ? AND station = ?', 
+                (dataset_id, station_id)).fetchall())
+        if datatype_ids:
+            dates = [rows.get(datatype) for datatype in datatype_ids]
+            return None if None in dates else min(dates)
+        return max(rows.values()) if rows else None
+
+    def update(self, dataset_id, records):
+        """Advance the watermarks to the newest date in records."""
+        newest = {}
+        for record in records:
+            key = (record['station'], record['datatype'])
+            date = record['date'][:10]
+            if date > newest.get(key, ''):
+                newest[key] = date
+        with self._lock:
+            self._db.executemany(
+                'INSERT INTO watermarks VALUES (?, ?, ?, ?) '
+                'ON CONFLICT (dataset, station, datatype) '
+                'DO UPDATE SET date = max(date, excluded.date)',
+                [(dataset_id, station, datatype, date) 
+                 for (station, datatype), date in newest.items()])
+
+    def close(self):
+        self._db.close()
+
+
+class ParquetSink(object):
+
+    def __init__(self, path, kind = 'data', dataset_id = None, max_open = 64):
+        """
+        Writes pages of results to a hive partitioned Parquet dataset.
+
+        Each page is converted to an Arrow record batch with a fixed 
+        schema and appended to an open file of its partition, so a 
+        backfill never has to fit in memory. data results are 
+        partitioned by dataset/station/year, stations results by 
+        dataset. Partition keys are not repeated inside the files; 
+        readers such as pq.read_table() and pd.read_parquet() add the 
+        station column back from the directory names. At most max_open 
+        files are kept open, the least recently written is closed 
+        first (a partition written to again gets a new part file), so 
+        a pull over many stations and years stays under the open file 
+        limit. Call close() (or use as a context manager) to finish 
+        the files; rows and files report what was written.
+        ------------------------------------------------------------------
+        path =          Root directory of the dataset.
+        ------------------------------------------------------------------
+        kind =          'data' or 'stations'.
+        ------------------------------------------------------------------
+        dataset_id =    Value of the dataset partition.
+        ------------------------------------------------------------------
+        max_open =      Most files open at once. Defaults to 64.
+        """
+        if pa is None:
+            raise ImportError('ParquetSink requires pyarrow: pip install pyarrow')
+        self.path = path
+        self.kind = kind
+        self.dataset_id = dataset_id or 'all'
+        self.schema = self.SCHEMAS[kind]()
+        self.rows = 0
+        self.files = []
+        self.max_open = max_open
+        self._writers = OrderedDict()
+        self._lock = threading.Lock()
+
+    SCHEMAS = dict(
+        data = lambda: pa.schema([('date', pa.timestamp('s')), 
+                                  ('datatype', pa.dictionary(pa.int32(), pa.string())), 
+                                  ('attributes', pa.dictionary(pa.int32(), pa.string())), 
+                                  ('value', pa.float64())]),
+        stations = lambda: pa.schema([('id', pa.string()), ('name', pa.string()), 
+                                      ('latitude', pa.float64()), ('longitude', pa.float64()), 
+                                      ('elevation', pa.float64()), ('elevationUnit', pa.string()), 
+                                      ('mindate', pa.string()), ('maxdate', pa.string()), 
+                                      ('datacoverage', pa.float64())]))
+
+    def _partition(self, record):
+        parts = [('dataset', self.dataset_id)]
+        if self.kind == 'data':
+            parts += [('station', record.get('station')), ('year', (record.get('date') or '')[:4])]
+        return tuple(f'{key}={quote(str(value), safe="")}' for key, value in parts)
+
+    def _batch(self, records):
+        arrays = []
+        for field in self.schema:
+            values = [record.get(field.name) for record in records]
+            if pa.types.is_timestamp(field.type):
+                array = pc.strptime(pa.array(values, pa.string()), 
+                                    format = '%Y-%m-%dT%H:%M:%S', unit = 's')
+            elif pa.types.is_dictionary(field.type):
+                array = pa.array(values, pa.string()).dictionary_encode()
+            else:
+                array = pa.array(values, field.type)
+            arrays.append(array)
+        return pa.RecordBatch.from_arrays(arrays, schema = self.schema)
+
+    def _writer(self, partition):
+        writer = self._writers.get(partition)
+        if writer is not None:
+            self._writers.move_to_end(partition)
+        else:
+            while len(self._writers) >= self.max_open:
+                self._writers.popitem(last = False)[1].close()
+            directory = os.path.join(self.path, *partition)
+            os.makedirs(directory, exist_ok = True)
+            path = os.path.join(directory, f'part-{uuid.uuid4().hex}.parquet')
+            writer = self._writers[partition] = pq.ParquetWriter(path, self.schema)
+            self.files.append(path)
+        return writer
+
+    def write(self, results):
+        """Append one page of results."""
+        groups = {}
+        for record in results:
+            groups.setdefault(self._partition(record), []).append(record)
+        with self._lock:
+            for partition, records in groups.items():
+                self._writer(partition).write_batch(self._batch(records))
+                self.rows += len(records)
+
+    def close(self):
+        with self._lock:
+            for writer in self._writers.values():
+                writer.close()
+            self._writers = OrderedDict()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
 
 
 class Noaa(object):
 
-    def __init__(self, api_key):
+    BASE_URL = 'https://www.ncdc.noaa.gov/cdo-web/api/v2'
+
+    def __init__(self, api_key, pool_size = 10, max_retries = 3, 
+                 timeout = 30, session = None, rate_limiter = None, 
+                 max_workers = 5, cache = None, retry = None, metrics = None, 
+                 base_url = None, decoder = None):
+        """
+        ------------------------------------------------------------------
+        ------------------------------------------------------------------
+        api_key =       NOAA CDO web services token.
+        ------------------------------------------------------------------
+        pool_size =     Number of keep-alive connections kept open 
+                        to ncdc.noaa.gov. Defaults to 10.
+        ------------------------------------------------------------------
+        max_retries =   Number of times a request is retried on 
+                        connection errors, 429 and 5xx responses. 
+                        Defaults to 3.
+        ------------------------------------------------------------------
+        timeout =       Seconds to wait for a response before 
+                        giving up. Accepts a (connect, read) tuple. 
+                        Defaults to 30.
+        ------------------------------------------------------------------
+        session =       An existing requests.Session to reuse. 
+                        If None, a pooled session is created.
+        ------------------------------------------------------------------
+        rate_limiter =  A RateLimiter to pace requests with. Share one 
+                        between every client using the same token. 
+                        If None, a RateLimiter with NOAA's default 
+                        limits is created.
+        ------------------------------------------------------------------
+        max_workers =   Number of pages fetched in parallel when 
+                        collect_all is True. Pages are still returned 
+                        in offset order and paced by the rate limiter. 
+                        Set to 1 to fetch pages one at a time. 
+                        Defaults to 5.
+        ------------------------------------------------------------------
+        cache =         A ResponseCache. Responses found in the cache 
+                        are returned without a request. Defaults to None.
+        ------------------------------------------------------------------
+        retry =         A RetryPolicy, to tune backoff and circuit 
+                        breaking or share them between clients. If 
+                        None, RetryPolicy(max_retries) is used.
+        ------------------------------------------------------------------
+        metrics =       A Metrics instance that records every request.
+        ------------------------------------------------------------------
+        base_url =      Root of the CDO v2 api. Defaults to BASE_URL; 
+                        point it at a mirror or the benchmark server.
+        ------------------------------------------------------------------
+        decoder =       Json decoder for response bodies: 'orjson', 
+                        'msgspec', 'json' or a function taking bytes 
+                        that raises ValueError on bad input. If None, 
+                        the fastest one installed is used. Unless 
+                        another decoder is chosen, and msgspec is 
+                        installed, data and stations pages requested 
+                        with df=True are decoded straight into 
+                        DataRecord and StationRecord structs instead 
+                        of one dict per record.
+
+        Noaa can be used as a context manager, or closed with 
+        .close(), to release the pooled connections.
+        """
         self._api_key = api_key
         self._header = dict(token=self._api_key)
+        self._timeout = timeout
+        self.base_url = (base_url or self.BASE_URL).rstrip('/')
+        self._pool_size = pool_size
+        if session is None:
+            session = self._build_session(pool_size)
+        self._session = session
+        if retry is None:
+            retry = RetryPolicy(max_retries)
+        self.retry = retry
+        self.metrics = metrics
+        if rate_limiter is None:
+            rate_limiter = RateLimiter()
+        self.rate_limiter = rate_limiter
+        self.max_workers = max_workers
+        self.cache = cache
+        self.checkpoint = None
+        self._decode = _json_decoder(decoder)
+        self._typed_records = msgspec is not None and decoder in (None, 'msgspec')
+        self._compact = False
+        self._scale = None
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        # Called with every body _get returns, see _seen.
+        self._on_body = None
+
+    def _build_session(self, pool_size):
+        # Retries are handled in _get so they pass through the rate limiter.
+        adapter = HTTPAdapter(pool_connections = pool_size, 
+                              pool_maxsize = pool_size)
+        session = req.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+
+    def close(self):
+        self._session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def quota_remaining(self):
+        return self.rate_limiter.remaining
+
+    @property
+    def query(self):
+        """
+        Deferred queries: noaa.query.data('GHCND').stations(ids) 
+        .between(a, b) plans the call and runs it only on collect(), 
+        stream() or to_parquet(). See Query.
+        """
+        return QueryBuilder(self)
 
+    def _checkpointed(self, checkpoint):
+        """
+        Return a shallow copy of this client, sharing its session, rate 
+        limiter and cache, that saves every response to checkpoint.
+        """
+        if checkpoint is None:
+            return self
+        if not isinstance(checkpoint, Checkpoint):
+            checkpoint = Checkpoint(checkpoint)
+        return self._clone(checkpoint = checkpoint)
 
+    def _typed(self, record, df):
+        """
+        Return a shallow copy of this client that decodes pages straight 
+        into record structs, if df is True and msgspec is available. 
+        The cache and checkpoint store plain json, so not with either.
+        """
+        if not df or record is None or not self._typed_records or \
+           self.cache is not None or self.checkpoint is not None:
+            return self
+        return self._clone(_decode = _page_decoder(record))
 
+    def _clone(self, **attrs):
+        client = copy.copy(self)
+        client.__dict__.update(attrs)
+        return client
 
+    def _seen(self, body):
+        # Query._probe sets _on_body on a serial clone to read the 
+        # metadata of every body a call receives, in request order.
+        if self._on_body is not None:
+            self._on_body(body)
+        return body
 
-    def _collect(self, url, params = None, collect_all=False, sleep=1, df = False):
+    def _stored(self, url, params, event = None, page = False):
+        for name, store in (('checkpoint', self.checkpoint), ('hit', self.cache)):
+            if store is not None:
+                body = store.get(url, params)
+                if body is not None and not (page and self._empty_page(url, params, body)):
+                    if event is not None:
+                        event['cache'] = name
+                    return body
+        if event is not None and self.cache is not None:
+            event['cache'] = 'miss'
+        return None
+
+    def _event(self, url, params):
+        return dict(url = url, params = params, cache = None, status = None, 
+                    retries = 0, bytes = 0, waited = 0.0, error = None, 
+                    started = tm.perf_counter())
+
+    def _emit(self, event):
+        if self.metrics is None:
+            return
+        event['latency'] = tm.perf_counter() - event.pop('started')
+        event['endpoint'] = _endpoint(event['url'])
+        event['params_hash'] = hashlib.sha1(
+            ResponseCache.key(event['url'], event['params']).encode()).hexdigest()[:12]
+        event['quota_remaining'] = self.rate_limiter.remaining
+        self.metrics.record(event)
+
+    def _store(self, url, params, body):
+        for store in (self.checkpoint, self.cache):
+            if store is not None:
+                store.set(url, params, body)
+
+    def _empty_page(self, url, params, body):
+        """
+        EmptyPage if body, the answer for a page at a known offset inside 
+        a result set, has no results, else None. Only a crawl's first 
+        request may answer {} for no matches.
+        """
+        if isinstance(body, dict) and body.get('results'):
+            return None
+        return EmptyPage(f"No results at offset {(params or {}).get('offset')} for url: {url}")
+
+    def _flight(self, url, params, page = False):
+        """
+        Return (key, future, leader) for a request. Identical requests 
+        in flight at the same time share one future; only the first 
+        caller, the leader, sends the request and resolves it.
+        """
+        # Clones decoding into structs or saving to a checkpoint must not 
+        # share bodies with other clients, so both are part of the key, 
+        # as is whether an empty body is an error.
+        key = (ResponseCache.key(url, params), self._decode, self.checkpoint, page)
+        with self._flights_lock:
+            future = self._flights.get(key)
+            if future is not None:
+                return key, future, False
+            future = self._flights[key] = Future()
+            return key, future, True
+
+    def _land(self, key):
+        with self._flights_lock:
+            return self._flights.pop(key)
+
+    def _get(self, url, params = None, page = False):
+        """
+        Send one request and return the decoded json body, retrying 
+        transient failures as the RetryPolicy allows. Fatal http errors 
+        (bad parameters, bad token) are raised straight away. Threads 
+        asking for the same url and params at the same time share one 
+        request and its decoded body (or its error). If page, the 
+        request is for a page inside a known result set, and a body 
+        without results is retried (and never stored) like a 5xx.
+        """
+        event = self._event(url, params)
+        try:
+            body = self._stored(url, params, event, page)
+            if body is not None:
+                return self._seen(body)
+            key, flight, leader = self._flight(url, params, page)
+            if not leader:
+                event['cache'] = 'coalesced'
+                return self._seen(flight.result())
+            try:
+                body = self._send(url, params, event, page)
+            except BaseException as e:
+                self._land(key).set_exception(e)
+                raise
+            self._land(key).set_result(body)
+            return self._seen(body)
+        except Exception as e:
+            event['error'] = type(e).__name__
+            raise
+        finally:
+            self._emit(event)
+
+    def _send(self, url, params, event, page = False):
+        attempt = 0
+        while True:
+            self.retry.check()
+            event['waited'] += self.rate_limiter.acquire()
+            status = retry_after = error = None
+            try:
+                resp = self._session.get(url, params = params, headers = self._header,
+                                         timeout = self._timeout)
+            except (req.ConnectionError, req.Timeout) as e:
+                error = e
+            else:
+                status = event['status'] = resp.status_code
+                event['bytes'] += len(resp.content)
+                if status in self.retry.RETRY_STATUSES:
+                    retry_after = resp.headers.get('Retry-After')
+                    error = req.HTTPError(f'{status} Error: {resp.reason} for url: {resp.url}', 
+                                          response = resp)
+                else:
+                    resp.raise_for_status()
+                    try:
+                        body = self._decode(resp.content)
+                    except ValueError as e:
+                        error = e
+                    else:
+                        error = self._empty_page(url, params, body) if page else None
+            if error is None:
+                self.retry.success()
+                self._store(url, params, body)
+                return body
+            self.retry.failure()
+            if attempt >= self.retry.max_retries:
+                raise error
+            self._backoff(attempt, retry_after, status)
+            attempt = event['retries'] = attempt + 1
+
+    def _backoff(self, attempt, retry_after, status):
+        wait = self.retry.delay(attempt, retry_after)
+        if status == 429:
+            # Hold back every thread sharing the limiter, not just this one
+            self.rate_limiter.pause(wait)
+        else:
+            tm.sleep(wait)
+
+    def _fetch_page(self, url, params, offset, sleep = 0):
+        results = self._get(url, dict(params or {}, offset = offset), page = True)['results']
+        if sleep:
+            tm.sleep(sleep)
+        return results
+
+    def _fetch_pages(self, url, params, offsets, sleep = 0):
+        """
+        Yield the results of each offset, in order, fetching in parallel. 
+        At most 2 * max_workers pages are held ahead of the consumer.
+        """
+        if self.max_workers > 1 and len(offsets) > 1:
+            with ThreadPoolExecutor(min(self.max_workers, len(offsets))) as pool:
+                pending = deque()
+                try:
+                    for offset in offsets:
+                        pending.append(pool.submit(self._fetch_page, url, params, offset, sleep))
+                        if len(pending) >= 2 * self.max_workers:
+                            yield pending.popleft().result()
+                    while pending:
+                        yield pending.popleft().result()
+                finally:
+                    for future in pending:
+                        future.cancel()
+        else:
+            for offset in offsets:
+                yield self._fetch_page(url, params, offset, sleep)
+
+
+
+
+
+    def _collect(self, url, params = None, collect_all=False, sleep=0, df = False, 
+                 progress = True, stream = False):
         """
                                     Collect all observations.
         --------------------------------------------------------------------------------
@@ -24,11 +1417,21 @@ class Noaa(object):
                     https://www.ncdc.noaa.gov/cdo-web/webservices/v2#gettingStarted
         --------------------------------------------------------------------------------
         --------------------------------------------------------------------------------
-        sleep =                 Amount of wait time because each request to api. 
-                                Defaults to 1.
+        collect_all =           If True, every page of the result set is fetched. 
+                                The first page is kept and limit defaults to 
+                                1000 (the maximum) unless one is passed.
+        --------------------------------------------------------------------------------
+        sleep =                 Extra wait time after each request to api, on 
+                                top of the rate limiter. Defaults to 0.
         --------------------------------------------------------------------------------
         df =                    If True, data is returned as a Pandas DataFrame
                                 If False, data is returnd at a json
+        --------------------------------------------------------------------------------
+        stream =                If True, a generator is returned that yields
+                                each page of results (a list, or a DataFrame
+                                if df is True) as soon as it arrives.
+        --------------------------------------------------------------------------------
+        progress =              If False, the progress bar is not printed.
         --------------------------------------------------------------------------------
                                             URLS:
 
@@ -50,41 +1453,154 @@ class Noaa(object):
 
         
 
-        if collect_all:
+        pages = self._pages(url, params, collect_all = collect_all, sleep = sleep, 
+                            progress = progress)
+        if stream:
+            return (self._frame(results, df) if df else results for results in pages)
 
-            call = req.get(url, headers = self._header, params = params).json()
-            total = call['metadata']['resultset']['count']
-            limit = call['metadata']['resultset']['limit']
-            params['offset'] = call['metadata']['resultset']['offset']
-            
-            cur = 0
-            data = []
+        return self._join(pages, df)
+
+    def _pages(self, url, params = None, collect_all=False, sleep=0, progress = True):
+        """Yield each page of results of a request, in offset order."""
+        if not collect_all:
+            yield self._results(self._get(url, params))
+            return
+
+        params, call, offsets = self._first_page(url, params)
+        if 'metadata' not in call:
+            yield self._results(call)
+            return
+        resultset = call['metadata']['resultset']
+        limit = resultset['limit']
+        total = resultset['count'] - max(resultset['offset'], 1) + 1
+
+        cur = min(len(call['results']), total)
+        if progress:
             self._printProgressBar(cur, total, prefix = f'{cur}/{total}', suffix = 'Complete', length = 50)
-            while cur < total:
-                params['offset'] = cur
-                query = req.get(url, params = params, headers = self._header)
-                data += query.json()['results']
-                tm.sleep(sleep)
-                cur += limit
-                if cur > total:
-                    cur = total
+        yield call['results']
+        for results in self._fetch_pages(url, params, offsets, sleep):
+            cur += limit
+            if cur > total:
+                cur = total
+            if progress:
                 self._printProgressBar(cur, total, 
                                     prefix = f'{cur}/{total}', 
                                     suffix = 'Complete', length = 50)
-        else:
-            data = req.get(url,headers=self._header, params=params)\
-                      .json()['results']
-        if df:
-            data = pd.DataFrame(data)
-            data.reset_index(inplace = True, drop = True)
-        
-        return data    
+            yield results
+
+    def _first_page(self, url, params = None):
+        """
+        Request the first page of a collect_all crawl. Returns the params 
+        (with limit defaulted), the body and the offsets of the 
+        remaining pages.
+        """
+        params = dict(params or {})
+        if params.get('limit') is None:
+            params['limit'] = MAX_LIMIT
+        call = self._get(url, params)
+        if 'metadata' not in call:
+            # NOAA answers a query with no matches with an empty {}
+            return params, call, []
+        resultset = call['metadata']['resultset']
+        first = max(resultset['offset'], 1)
+        return params, call, list(range(first + resultset['limit'], resultset['count'] + 1, 
+                                        resultset['limit']))
+
+    def _results(self, body):
+        # Lookups by id (e.g. stations/GHCND:USW00094728) answer with the 
+        # record itself rather than a page of results.
+        if 'results' in body:
+            return body['results']
+        return [body] if body and 'metadata' not in body else []
+
+    def _join(self, pages, df = False):
+        """
+        Join pages of results into one list, or, if df, into one 
+        DataFrame built column by column with a FrameBuilder (pivoted 
+        with FrameBuilder.wide if df is 'wide', into Records if the 
+        client is compact).
+        """
+        if df or self._compact:
+            records = Records.from_pages(pages)
+            if df == 'wide':
+                return FrameBuilder.wide(records.to_frame(), self._scale)
+            return records.to_frame() if df else records
+
+        data = []
+        for results in pages:
+            data += results
+        return data
+
+    def _frame(self, data, df = True):
+        return self._join([data], df)
+
+    def _collect_windows(self, url, params, windows, collect_all=False, sleep=0, df = False, 
+                         stream = False):
+        """
+        Run _collect once per (startdate, enddate) window and join the 
+        results in window order. The first pages of the windows and then 
+        all their remaining pages go through one pool of max_workers 
+        threads, so no more requests are in flight than for a single 
+        window. When streaming, windows are fetched one after another.
+        """
+        if stream:
+            pages = (results for start, end in windows 
+                     for results in self._pages(url, dict(params, startdate = start, enddate = end), 
+                                                collect_all = collect_all, sleep = sleep, 
+                                                progress = False))
+            return (self._frame(results, df) if df else results for results in pages)
+
+        def first(window):
+            start, end = window
+            window = dict(params, startdate = start, enddate = end)
+            if not collect_all:
+                return window, self._get(url, window), []
+            return self._first_page(url, window)
+
+        with ThreadPoolExecutor(max(1, self.max_workers)) as pool:
+            firsts = list(pool.map(first, windows))
+            rest = pool.map(lambda job: self._fetch_page(url, job[0], job[1], sleep), 
+                            [(window, offset) for window, call, offsets in firsts 
+                             for offset in offsets])
+            pages = []
+            for window, call, offsets in firsts:
+                pages.append(self._results(call))
+                pages += [next(rest) for _ in offsets]
+        return self._join(pages, df)
+
+    def _date_windows(self, dataset_id, start_date, end_date):
+        """
+        Split start_date - end_date into consecutive windows no longer 
+        than NOAA allows for dataset_id. Returns a list of 
+        (start, end) string tuples; the original strings are kept 
+        at either end so date times pass through unchanged.
+        """
+        years = DATE_RANGE_YEARS.get(dataset_id, 1)
+        start = dt.date.fromisoformat(start_date[:10])
+        end = dt.date.fromisoformat(end_date[:10])
+
+        windows = []
+        while True:
+            try:
+                stop = start.replace(year = start.year + years)
+            except ValueError:
+                # Feb 29th
+                stop = start.replace(year = start.year + years, day = 28)
+            stop -= dt.timedelta(days = 1)
+            if stop >= end:
+                windows.append([start.isoformat(), end_date])
+                break
+            windows.append([start.isoformat(), stop.isoformat()])
+            start = stop + dt.timedelta(days = 1)
+        windows[0][0] = start_date
+
+        return [tuple(window) for window in windows]
         
     def datasets(self, dataset_id = None, datatype_id = None, 
                 location_id = None, station_id = None, 
                 start_date = None, end_date = None, 
                 sort_field = None, sort_order = None, 
-                limit = None, offset = None, collect_all = False, sleep=1, df=False):
+                limit = None, offset = None, collect_all = False, sleep=0, df=False, stream = False):
         """
                     Returns a description of available datasets
         ------------------------------------------------------------------
@@ -140,15 +1656,20 @@ class Noaa(object):
                         Specifies the amount of time between 
                         each request call to Noaa.
 
-                        Defaults to 1 second.
+                        Defaults to 0, the rate limiter
+                        paces requests.
         --------------------------------------------------------------------------------
         df =            If True, data is returned as a Pandas DataFrame
                         If False, data is returnd at a json
+        --------------------------------------------------------------------------------
+        stream =        If True, a generator is returned that yields
+                        each page of results (a list, or a DataFrame
+                        if df is True) as soon as it arrives.
 
 
             """
         
-        url = 'https://www.ncdc.noaa.gov/cdo-web/api/v2/datasets'
+        url = self.base_url + '/datasets'
         url = self._format_url(url, dataset_id)
         
         params = dict(datatypeid = datatype_id, 
@@ -162,7 +1683,8 @@ class Noaa(object):
                     offset = offset)
             
         
-        return self._collect(url, params, collect_all=collect_all, sleep=sleep, df=df)
+        return self._collect(url, params, collect_all=collect_all, sleep=sleep, df=df, 
+                             stream=stream)
             
 
     def data_category(self, data_category_id = None, 
@@ -170,7 +1692,7 @@ class Noaa(object):
                     station_id = None, start_date = None, 
                     end_date = None, sort_field = None, 
                     sort_order = None, limit = None, 
-                    offset = None, collect_all = False, sleep = 1, df = False):
+                    offset = None, collect_all = False, sleep = 0, df = False, stream = False):
        
         """         Returns information about data categories
         ------------------------------------------------------------------
@@ -228,13 +1750,18 @@ class Noaa(object):
                             sleep specifies the amount of time between 
                             each request call to Noaa.
 
-                            Defaults to 1 second
+                            Defaults to 0, the rate limiter
+                            paces requests.
         --------------------------------------------------------------------------------
         df =                If True, data is returned as a Pandas DataFrame
                             If False, data is returnd at a json
+        --------------------------------------------------------------------------------
+        stream =            If True, a generator is returned that yields
+                            each page of results (a list, or a DataFrame
+                            if df is True) as soon as it arrives.
         """
 
-        url = 'https://www.ncdc.noaa.gov/cdo-web/api/v2/datacategories'
+        url = self.base_url + '/datacategories'
         url = self._format_url(url, data_category_id)
 
         
@@ -247,13 +1774,14 @@ class Noaa(object):
                 limit = limit,
                 offset = offset)
 
-        return self._collect(url, params, collect_all=collect_all, sleep=sleep, df=df)
+        return self._collect(url, params, collect_all=collect_all, sleep=sleep, df=df, 
+                             stream=stream)
 
     def data_types(self, datatype_id = None, dataset_id = None, 
                 location_id = None, station_id = None, 
                 data_category_id = None, start_date = None, 
                 end_date = None, sort_field = None,
-                limit = None, offset = None, collect_all= False, sleep = 1, df = False):
+                limit = None, offset = None, collect_all= False, sleep = 0, df = False, stream = False):
 
         """
                     Returns information about datatypes. 
@@ -319,14 +1847,19 @@ class Noaa(object):
                             sleep specifies the amount of time between 
                             each request call to Noaa.
 
-                            Defaults to 1 second
+                            Defaults to 0, the rate limiter
+                            paces requests.
         --------------------------------------------------------------------------------
         df =                If True, data is returned as a Pandas DataFrame
                             If False, data is returnd at a json
+        --------------------------------------------------------------------------------
+        stream =            If True, a generator is returned that yields
+                            each page of results (a list, or a DataFrame
+                            if df is True) as soon as it arrives.
         """
         
  
-        url = 'https://www.ncdc.noaa.gov/cdo-web/api/v2/datatypes'
+        url = self.base_url + '/datatypes'
         url = self._format_url(url, datatype_id)
         
         params = dict(datasetid = dataset_id,
@@ -340,13 +1873,14 @@ class Noaa(object):
                     offset = offset)
 
         
-        return self._collect(url, params, collect_all=collect_all, sleep=sleep, df=df)
+        return self._collect(url, params, collect_all=collect_all, sleep=sleep, df=df, 
+                             stream=stream)
 
     def location_categories(self, location_category = None, 
                             dataset_id = None, start_date = None,
                             end_date = None, sort_field = None,
                             sort_order = None, limit = None,
-                            offset = None, collect_all= False, sleep = 1, df = False):
+                            offset = None, collect_all= False, sleep = 0, df = False, stream = False):
         
         """
                 Returns information about location categories.
@@ -393,14 +1927,19 @@ class Noaa(object):
         sleep =             If all results is marked as true. 
                             sleep specifies the amount of time between 
                             each request call to Noaa
-                            Defaults to 1 second
+                            Defaults to 0, the rate limiter
+                            paces requests.
         --------------------------------------------------------------------------------
         df =                If True, data is returned as a Pandas DataFrame
                             If False, data is returnd at a json
+        --------------------------------------------------------------------------------
+        stream =            If True, a generator is returned that yields
+                            each page of results (a list, or a DataFrame
+                            if df is True) as soon as it arrives.
         """
 
         
-        url = 'https://www.ncdc.noaa.gov/cdo-web/api/v2/locationcategories'
+        url = self.base_url + '/locationcategories'
         url = self._format_url(url, location_category)
 
         params = dict( 
@@ -410,13 +1949,14 @@ class Noaa(object):
                             offset = offset
         )
 
-        return self._collect(url, params, collect_all=collect_all, sleep=sleep, df=df)
+        return self._collect(url, params, collect_all=collect_all, sleep=sleep, df=df, 
+                             stream=stream)
 
     def locations(self, location_id = None, dataset_id = None,
                   location_category_id = None, data_category_id = None,
                   start_date = None, end_date = None,
                   sort_field = None, sort_order = None,
-                  limit = None, offset = None, collect_all= False, sleep = 1, df = False):
+                  limit = None, offset = None, collect_all= False, sleep = 0, df = False, stream = False):
         
         """
                     Returns information about locations.
@@ -470,14 +2010,19 @@ class Noaa(object):
         ------------------------------------------------------------------
         sleep =                If all results is marked as true. sleep 
                                specifies the amount of time between each 
-                               request call to Noaa. Defaults to 1 second
+                               request call to Noaa. Defaults to 0, the 
+                               rate limiter paces requests.
         --------------------------------------------------------------------------------
         df =                   If True, data is returned as a Pandas DataFrame
                                If False, data is returnd at a json
+        --------------------------------------------------------------------------------
+        stream =               If True, a generator is returned that yields
+                               each page of results (a list, or a DataFrame
+                               if df is True) as soon as it arrives.
         """
 
 
-        url = 'https://www.ncdc.noaa.gov/cdo-web/api/v2/locations'
+        url = self.base_url + '/locations'
         url = self._format_url(url, location_id)
 
 
@@ -488,14 +2033,16 @@ class Noaa(object):
                  sortorder = sort_order, limit = limit,
                  offset = offset)
 
-        return self._collect(url, params, collect_all=collect_all, sleep=sleep, df=df)
+        return self._collect(url, params, collect_all=collect_all, sleep=sleep, df=df, 
+                             stream=stream)
 
     
     def stations(self, station_id = None, dataset_id = None, location_id = None,
                  data_category_id = None, datatype_id = None, extent = None,
                  start_date = None, end_date = None, sort_field = None,
                  sort_order = None, limit = None, offset = None, collect_all= False, 
-                 sleep = 1, df = False):
+                 sleep = 0, df = False, stream = False, checkpoint = None, 
+                 parquet = None, compact = False):
         
         """
                     Returns information about weather stations.
@@ -556,27 +2103,59 @@ class Noaa(object):
         ------------------------------------------------------------------
         sleep =            If all results is marked as true. 
                            sleep specifies the amount of time between 
-                           each request call to Noaa. Defaults to 1 second
+                           each request call to Noaa. Defaults to 0, the 
+                           rate limiter paces requests.
         --------------------------------------------------------------------------------
         df =               If True, data is returned as a Pandas DataFrame
                            If False, data is returnd at a json
+        --------------------------------------------------------------------------------
+        stream =           If True, a generator is returned that yields
+                           each page of results (a list, or a DataFrame
+                           if df is True) as soon as it arrives.
+        ------------------------------------------------------------------
+        checkpoint =       A checkpoint id (or Checkpoint). Each page is 
+                           saved to disk as it arrives and a rerun of the 
+                           same call only fetches the missing pages.
+        ------------------------------------------------------------------
+        parquet =          A directory (or ParquetSink). Pages are written 
+                           to a partitioned Parquet dataset as they 
+                           arrive and the closed ParquetSink is returned 
+                           instead of the results. Requires pyarrow.
+        ------------------------------------------------------------------
+        compact =          If True (and df and stream are False), the 
+                           results come back as Records, a list like 
+                           container of column buffers that takes a 
+                           fraction of the memory of a list of dicts.
         """
 
-        url = 'https://www.ncdc.noaa.gov/cdo-web/api/v2/stations'
+        url = self.base_url + '/stations'
         url = self._format_url(url, station_id)
 
 
         params = dict(datasetid = dataset_id, locationid = location_id,
                       datacategoryid = data_category_id, datatypeid = datatype_id,
-                      extent = extent, sortfield = sort_field, limit = limit,
+                      extent = extent, startdate = start_date, enddate = end_date, 
+                      sortfield = sort_field, sortorder = sort_order, limit = limit,
                       offset = offset)
 
-        return self._collect(url, params, collect_all=collect_all, sleep=sleep, df=df)
+        client = self._checkpointed(checkpoint)
+        if parquet is not None:
+            pages = client._collect(url, params, collect_all=collect_all, sleep=sleep, stream=True)
+            return self._write_parquet(pages, parquet, 'stations', dataset_id)
+
+        if compact and not df and not stream:
+            client = client._clone(_compact = True)
+        if station_id is None:
+            client = client._typed(StationRecord, df or client._compact)
+        return client._collect(url, params, collect_all=collect_all, sleep=sleep, df=df, 
+                               stream=stream)
 
     def data(self, dataset_id, start_date, end_date, datatype_id = None, 
          location_id = None, station_id = None, units = None, 
          sort_field = None, sort_order = None, limit = None, 
-         offset = None, include_metadata = None, collect_all= False, sleep = 1, df = False):
+         offset = None, include_metadata = None, collect_all= False, sleep = 0, df = False, 
+         stream = False, checkpoint = None, parquet = None, compact = False, 
+         progress = True):
     
         """
                         Fetches weather data. 
@@ -593,7 +2172,9 @@ class Noaa(object):
                            Data returned will be after the specified date. 
                            Annual and Monthly data will be limited to 
                            a ten year range while all other data will be 
-                           limted to a one year range.
+                           limted to a one year range. Longer ranges are 
+                           split into compliant windows that are fetched 
+                           in parallel and returned in date order.
         ------------------------------------------------------------------
         end_date =         REQUIRED
                            Accepts valid ISO formated date (YYYY-MM-DD) 
@@ -603,61 +2184,323 @@ class Noaa(object):
                            to a ten year range while all other data 
                            will be limted to a one year range.
         ------------------------------------------------------------------
-        datatype_id =      Accepts a valid data type id or a chain of 
-                           data type ids separated by ampersands. 
-                           Data returned will contain 
-                           all of the data type(s) specified.
+        datatype_id =      Accepts a valid data type id or a chain of 
+                           data type ids separated by ampersands. 
+                           Data returned will contain 
+                           all of the data type(s) specified.
+        ------------------------------------------------------------------
+        location_id =      Accepts a valid location id or a chain of location 
+                           ids separated by ampersands. Data returned will 
+                           contain data for the location(s) specified.
+        ------------------------------------------------------------------
+        station_id =       Accepts a valid station id or a chain of of station 
+                           ids separated by ampersands. Data returned will 
+                           contain data for the station(s) specified.
+        ------------------------------------------------------------------
+        units =            Accepts the literal strings 'standard' 
+                           or 'metric'. Data will be scaled and 
+                           converted to the specified units. 
+                           If a unit is not provided then no scaling 
+                           nor conversion will take place.
+        ------------------------------------------------------------------
+        sort_field =       The field to sort results by. 
+                           Supports id, name, mindate, maxdate, 
+                           and datacoverage fields.
+        ------------------------------------------------------------------
+        sort_order =       Which order to sort by, asc or desc. 
+                           Defaults to asc.
+        ------------------------------------------------------------------
+        limit =            Defaults to 25, limits the number of results 
+                           in the response. Maximum is 1000. When the 
+                           dates are split into windows and collect_all 
+                           is False, limit and offset apply to each 
+                           window: limit = 25 over three one year 
+                           windows returns up to 75 results.
+        ------------------------------------------------------------------
+        offset =           Defaults to 0, used to offset the resultlist.
+        ------------------------------------------------------------------
+        include_metadata = Defaults to true. 
+                           Used to improve response time by preventing 
+                           the calculation of result metadata.
+        ------------------------------------------------------------------
+        all_results =      Returns all data observations
+        ------------------------------------------------------------------
+        sleep =            If all results is marked as true. sleep 
+                           specifies the amount of time between each request 
+                           call to Noaa. 
+                           Defaults to 0, the rate limiter
+                           paces requests.
+        --------------------------------------------------------------------------------
+        df =               If True, data is returned as a Pandas DataFrame
+                           If False, data is returnd at a json
+                           If 'wide', a DataFrame indexed by date with 
+                           (field, station, datatype) columns: 'value' 
+                           and the parsed measurement, quality and 
+                           source flags. Raw values (no units) of 
+                           datasets in RAW_SCALE are scaled to metric 
+                           units. See FrameBuilder.wide.
+        --------------------------------------------------------------------------------
+        stream =           If True, a generator is returned that yields
+                           each page of results (a list, or a DataFrame
+                           if df is True) as soon as it arrives.
+        ------------------------------------------------------------------
+        checkpoint =       A checkpoint id (or Checkpoint). Each page is 
+                           saved to disk as it arrives and a rerun of the 
+                           same call only fetches the missing pages.
+        ------------------------------------------------------------------
+        parquet =          A directory (or ParquetSink). Pages are written 
+                           to a partitioned Parquet dataset as they 
+                           arrive and the closed ParquetSink is returned 
+                           instead of the results. Requires pyarrow.
+        ------------------------------------------------------------------
+        compact =          If True (and df and stream are False), the 
+                           results come back as Records, a list like 
+                           container of column buffers that takes a 
+                           fraction of the memory of a list of dicts.
+        ------------------------------------------------------------------
+        progress =         If False, no progress bar is printed for a 
+                           collect_all crawl. Calls run side by side 
+                           (data_batch(), sync()) pass False.
+        
+        """
+        
+        url = self.base_url + '/data?datasetid='+ dataset_id
+
+        params = dict(datatypeid = datatype_id, locationid = location_id,
+                    stationid = station_id, startdate = start_date,
+                    enddate = end_date, units = units, sortfield = sort_field,
+                    limit = limit, offset = offset, includemetadata = include_metadata)
+
+        client = self._checkpointed(checkpoint)
+        windows = self._date_windows(dataset_id, start_date, end_date)
+        if parquet is not None:
+            df, stream = False, True
+        if compact and not df and not stream:
+            client = client._clone(_compact = True)
+        client = client._typed(DataRecord, df or client._compact)
+        if df == 'wide' and units is None:
+            client = client._clone(_scale = RAW_SCALE.get(dataset_id))
+        if len(windows) > 1:
+            results = client._collect_windows(url, params, windows, collect_all=collect_all, 
+                                              sleep=sleep, df=df, stream=stream)
+        else:
+            results = client._collect(url, params, collect_all=collect_all, sleep=sleep, df=df, 
+                                      progress=progress, stream=stream)
+        if parquet is not None:
+            return self._write_parquet(results, parquet, 'data', dataset_id)
+
+        return results
+
+    def _write_parquet(self, pages, parquet, kind, dataset_id = None):
+        sink = parquet if isinstance(parquet, ParquetSink) else \
+               ParquetSink(parquet, kind = kind, dataset_id = dataset_id)
+        with sink:
+            for results in pages:
+                sink.write(results)
+        return sink
+
+    def data_batch(self, dataset_id, station_ids, start_date, end_date, 
+                   datatype_ids = None, units = None, rows_per_station = None, 
+                   sleep = 0, df = False):
+        """
+                Fetches weather data for many stations at once.
+        ------------------------------------------------------------------
+        ------------------------------------------------------------------
+        Stations are chained into combined requests, sized so that each 
+        request's results fill its 1000 row pages as fully as possible. 
+        The requests run in parallel under the rate limiter and every 
+        page is collected. Results are returned as one list (or one 
+        DataFrame) in station group order.
+        ------------------------------------------------------------------
+        dataset_id =       REQUIRED. A single valid dataset id.
+        ------------------------------------------------------------------
+        station_ids =      REQUIRED. A list of station ids.
+        ------------------------------------------------------------------
+        start_date =       REQUIRED. ISO formated date (YYYY-MM-DD). 
+                           Long ranges are split as in data().
+        ------------------------------------------------------------------
+        end_date =         REQUIRED. ISO formated date (YYYY-MM-DD).
+        ------------------------------------------------------------------
+        datatype_ids =     A list of data type ids. If None, all 
+                           data types are returned.
+        ------------------------------------------------------------------
+        units =            'standard' or 'metric'. See data().
+        ------------------------------------------------------------------
+        rows_per_station = Expected rows per station in one date 
+                           window, used to size the requests. If None 
+                           it is estimated from the dataset and the 
+                           number of data types.
+        ------------------------------------------------------------------
+        sleep =            Extra wait time after each request.
+        ------------------------------------------------------------------
+        df =               If True, data is returned as a Pandas DataFrame
+                           If False, data is returnd at a json
+        """
+        calls = self._batch_calls(dataset_id, station_ids, start_date, end_date, 
+                                  datatype_ids, units, rows_per_station, sleep)
+        return self._collect_batch(calls, df)
+
+    def _batch_calls(self, dataset_id, station_ids, start_date, end_date, 
+                     datatype_ids = None, units = None, rows_per_station = None, sleep = 0):
+        """Keyword arguments of the data() calls that make up a batch."""
+        plan = self._plan_batch(dataset_id, station_ids, start_date, end_date, 
+                                datatype_ids, rows_per_station)
+        return [dict(dataset_id = dataset_id, start_date = start_date, end_date = end_date, 
+                     station_id = group, datatype_id = datatype_ids, units = units, 
+                     collect_all = True, sleep = sleep)
+                for group in plan]
+
+    def _collect_batch(self, calls, df = False):
+        # The calls run in parallel and each fetches its own pages in 
+        # turn, so at most max_workers requests are in flight
+        serial = self._clone(max_workers = 1)
+        with ThreadPoolExecutor(max(1, min(self.max_workers, len(calls)))) as pool:
+            return self._join(pool.map(lambda kwargs: serial.data(**kwargs, progress = False), 
+                                       calls), df)
+
+    def _plan_batch(self, dataset_id, station_ids, start_date, end_date, 
+                    datatype_ids = None, rows_per_station = None):
+        """
+        Group station_ids into chained requests. Each group holds up to 
+        MAX_IDS_PER_REQUEST stations; the size is picked to need the 
+        fewest 1000 row pages per station. Returns a list of id lists.
+        """
+        station_ids = list(station_ids)
+        if not station_ids:
+            return []
+        if rows_per_station is None:
+            start, end = self._date_windows(dataset_id, start_date, end_date)[0]
+            days = (dt.date.fromisoformat(end[:10]) - dt.date.fromisoformat(start[:10])).days + 1
+            records = max(1, round(days / RECORD_DAYS.get(dataset_id, 1)))
+            rows_per_station = records * (len(datatype_ids) if datatype_ids else DEFAULT_DATATYPES)
+
+        # Pages per station for a group of size n is ceil(n * rows / 1000) / n, 
+        # prefer the larger group on ties since it means fewer requests.
+        size = min(range(1, min(MAX_IDS_PER_REQUEST, len(station_ids)) + 1),
+                   key = lambda n: (-(-n * rows_per_station // MAX_LIMIT) / n, -n))
+        return [station_ids[i:i + size] for i in range(0, len(station_ids), size)]
+
+    def sync(self, dataset_id, station_ids, state, start_date, end_date = None, 
+             datatype_ids = None, units = None, check_stations = True, location_id = None, 
+             df = False):
+        """
+                Fetches only the observations added since the last sync.
+        ------------------------------------------------------------------
         ------------------------------------------------------------------
-        location_id =      Accepts a valid location id or a chain of location 
-                           ids separated by ampersands. Data returned will 
-                           contain data for the location(s) specified.
+        The date of the newest record ingested for each station and data 
+        type is kept in state. Each station is queried from the day after 
+        its watermark, stations whose stations() maxdate shows nothing 
+        new are skipped, and the rest are fetched with chained requests 
+        as in data_batch(). A station is only skipped on what the 
+        listing says about it; one the listing does not reach is 
+        fetched. The watermarks are advanced once the new records have 
+        been fetched.
         ------------------------------------------------------------------
-        station_id =       Accepts a valid station id or a chain of of station 
-                           ids separated by ampersands. Data returned will 
-                           contain data for the station(s) specified.
+        dataset_id =       REQUIRED. A single valid dataset id.
         ------------------------------------------------------------------
-        units =            Accepts the literal strings 'standard' 
-                           or 'metric'. Data will be scaled and 
-                           converted to the specified units. 
-                           If a unit is not provided then no scaling 
-                           nor conversion will take place.
+        station_ids =      REQUIRED. A list of station ids.
         ------------------------------------------------------------------
-        sort_field =       The field to sort results by. 
-                           Supports id, name, mindate, maxdate, 
-                           and datacoverage fields.
+        state =            REQUIRED. A SyncState (or the path of one).
         ------------------------------------------------------------------
-        sort_order =       Which order to sort by, asc or desc. 
-                           Defaults to asc.
+        start_date =       REQUIRED. ISO formated date (YYYY-MM-DD) to 
+                           start from for stations never synced.
         ------------------------------------------------------------------
-        limit =            Defaults to 25, limits the number of results 
-                           in the response. Maximum is 1000.
+        end_date =         ISO formated date. Defaults to today.
         ------------------------------------------------------------------
-        offset =           Defaults to 0, used to offset the resultlist.
+        datatype_ids =     A list of data type ids. If None, all data 
+                           types are fetched and a station's watermark 
+                           is the newest date of any of its data types.
         ------------------------------------------------------------------
-        include_metadata = Defaults to true. 
-                           Used to improve response time by preventing 
-                           the calculation of result metadata.
+        units =            'standard' or 'metric'. See data().
         ------------------------------------------------------------------
-        all_results =      Returns all data observations
+        check_stations =   If True, a stations() listing is used to skip 
+                           stations with no new data. It is read one 
+                           page at a time and stops before it costs as 
+                           many requests as the data calls it could 
+                           save.
+        ------------------------------------------------------------------
+        location_id =      Location id (e.g. FIPS:37) the stations are 
+                           in, to list only that area instead of every 
+                           station of the dataset.
         ------------------------------------------------------------------
-        sleep =            If all results is marked as true. sleep 
-                           specifies the amount of time between each request 
-                           call to Noaa. 
-                           Defaults to 1 second
-        --------------------------------------------------------------------------------
         df =               If True, data is returned as a Pandas DataFrame
                            If False, data is returnd at a json
-        
         """
-        
-        url = 'https://www.ncdc.noaa.gov/cdo-web/api/v2/data?datasetid='+ dataset_id
+        if not isinstance(state, SyncState):
+            state = SyncState(state)
+        end_date = end_date or dt.date.today().isoformat()
+        since = self._sync_since(dataset_id, station_ids, state, start_date, datatype_ids)
+        if check_stations and since:
+            since = self._sync_check(dataset_id, since, end_date, datatype_ids, location_id)
+        results = self._collect_batch(self._sync_calls(dataset_id, since, end_date, 
+                                                       datatype_ids, units))
+        return self._sync_commit(dataset_id, state, since, results, df)
 
-        params = dict(datatypeid = datatype_id, locationid = location_id,
-                    stationid = station_id, startdate = start_date,
-                    enddate = end_date, units = units, sortfield = sort_field,
-                    limit = limit, offset = offset, includemetadata = include_metadata)
+    def _sync_since(self, dataset_id, station_ids, state, start_date, datatype_ids = None):
+        """First date to request for each station."""
+        since = {}
+        for station in station_ids:
+            mark = state.watermark(dataset_id, station, datatype_ids)
+            if mark is None:
+                since[station] = start_date[:10]
+            else:
+                since[station] = (dt.date.fromisoformat(mark) + dt.timedelta(days = 1)).isoformat()
+        return since
+
+    def _sync_check(self, dataset_id, since, end_date, datatype_ids = None, location_id = None):
+        """
+        Read the stations() listing a page at a time, for at most 
+        _sync_offsets pages, and return the stations of since still due.
+        """
+        listing, complete = [], False
+        for offset in self._sync_offsets(dataset_id, since, end_date, datatype_ids):
+            page = self.stations(**self._sync_page(dataset_id, since, location_id, offset))
+            listing += page
+            if len(page) < MAX_LIMIT:
+                complete = True
+                break
+        return self._sync_due(since, listing, complete and location_id is None)
+
+    def _sync_page(self, dataset_id, since, location_id, offset):
+        """stations() arguments for the listing page at offset."""
+        return dict(dataset_id = dataset_id, location_id = location_id, 
+                    start_date = min(since.values()), limit = MAX_LIMIT, offset = offset)
+
+    def _sync_offsets(self, dataset_id, since, end_date, datatype_ids = None):
+        """
+        Offsets of the stations() listing pages worth reading: fewer 
+        than the data calls a full sync makes, since at best the 
+        listing lets every one of them be skipped.
+        """
+        calls = len(self._sync_calls(dataset_id, since, end_date, datatype_ids))
+        return range(1, (calls - 1) * MAX_LIMIT + 1, MAX_LIMIT)
+
+    def _sync_due(self, since, listing, complete = False):
+        """
+        Drop the stations listed with a maxdate before their next date. 
+        Stations missing from the listing are kept unless it is the 
+        complete dataset listing, where missing means no data since its 
+        start date.
+        """
+        maxdates = {station['id']: station.get('maxdate') or '' for station in listing}
+        return {station: date for station, date in since.items() 
+                if maxdates.get(station, '' if complete else date)[:10] >= date}
 
-        return self._collect(url, params, collect_all=collect_all, sleep=sleep, df=df)
+    def _sync_calls(self, dataset_id, since, end_date, datatype_ids = None, units = None):
+        groups = {}
+        for station, date in since.items():
+            if date <= end_date[:10]:
+                groups.setdefault(date, []).append(station)
+        calls = []
+        for date, stations in sorted(groups.items()):
+            calls += self._batch_calls(dataset_id, stations, date, end_date, datatype_ids, units)
+        return calls
+
+    def _sync_commit(self, dataset_id, state, since, results, df = False):
+        results = [record for record in results 
+                   if record['date'][:10] >= since.get(record['station'], '')]
+        state.update(dataset_id, results)
+        return self._join([results], df)
 
 
     def _printProgressBar (self, iteration, total, prefix = '', suffix = '', decimals = 1, length = 100, fill = '█', printEnd = "\r"):
@@ -689,3 +2532,1198 @@ class Noaa(object):
             formatted = url + '?'
 
         return formatted
+
+
+
+class AsyncNoaa(Noaa):
+
+    def __init__(self, api_key, pool_size = 10, timeout = 30, 
+                 session = None, rate_limiter = None, cache = None, 
+                 retry = None, metrics = None, base_url = None, decoder = None, 
+                 max_retries = 3, max_workers = None):
+        """
+        asyncio version of Noaa, backed by an aiohttp connection pool.
+
+        Has the same endpoint methods as Noaa (datasets, data_category, 
+        data_types, location_categories, locations, stations and data), 
+        each returning a coroutine, or an async generator of pages when 
+        stream is True:
+
+            async with AsyncNoaa(api_key) as noaa:
+                stations = await noaa.stations(dataset_id = 'GHCND')
+                async for page in noaa.data('GHCND', start, end, stream = True):
+                    ...
+
+        Pages of a collect_all crawl, and any number of concurrent 
+        calls, are multiplexed on the running event loop and paced by 
+        the rate limiter.
+        ------------------------------------------------------------------
+        ------------------------------------------------------------------
+        api_key =       NOAA CDO web services token.
+        ------------------------------------------------------------------
+        pool_size =     Maximum number of open connections. Defaults to 10.
+        ------------------------------------------------------------------
+        timeout =       Total seconds allowed per request. Defaults to 30.
+        ------------------------------------------------------------------
+        session =       An existing aiohttp.ClientSession to reuse. 
+                        If None, one is created on first use.
+        ------------------------------------------------------------------
+        rate_limiter =  A RateLimiter to pace requests with. May be 
+                        shared with synchronous Noaa clients using 
+                        the same token.
+        ------------------------------------------------------------------
+        cache =         A ResponseCache, which may be shared with 
+                        synchronous Noaa clients.
+        ------------------------------------------------------------------
+        retry =         A RetryPolicy. If None, RetryPolicy(max_retries) 
+                        is used.
+        ------------------------------------------------------------------
+        metrics =       A Metrics instance that records every request.
+        ------------------------------------------------------------------
+        base_url =      Root of the CDO v2 api. Defaults to BASE_URL.
+        ------------------------------------------------------------------
+        decoder =       Json decoder for response bodies, as for Noaa.
+        ------------------------------------------------------------------
+        max_retries =   Number of times a request is retried, as for 
+                        Noaa. Defaults to 3.
+        ------------------------------------------------------------------
+        max_workers =   Pages of a collect_all crawl requested ahead of 
+                        the consumer, times two. Defaults to pool_size.
+        """
+        if aiohttp is None:
+            raise ImportError('AsyncNoaa requires aiohttp: pip install aiohttp')
+        super().__init__(api_key, pool_size = pool_size, max_retries = max_retries, 
+                         timeout = timeout, session = session, rate_limiter = rate_limiter, 
+                         max_workers = pool_size if max_workers is None else max_workers, 
+                         cache = cache, retry = retry, metrics = metrics, base_url = base_url, 
+                         decoder = decoder)
+        self._parent = None
+
+    def _build_session(self, pool_size):
+        # The ClientSession needs a running event loop; see _client
+        return None
+
+    def _clone(self, **attrs):
+        # Copies share the ClientSession of the client they came from, 
+        # even if it is only created later.
+        return super()._clone(_parent = self._parent or self, **attrs)
+
+    def _client(self):
+        if self._parent is not None:
+            return self._parent._client()
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit = self._pool_size)
+            self._session = aiohttp.ClientSession(
+                connector = connector, 
+                timeout = aiohttp.ClientTimeout(total = self._timeout))
+        return self._session
+
+    async def close(self):
+        if self._session is not None:
+            await self._session.close()
+
+    def __enter__(self):
+        raise TypeError('AsyncNoaa is an async context manager, use async with')
+
+    def __exit__(self, *exc):
+        pass
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _get(self, url, params = None, page = False):
+        """
+        Coroutine version of Noaa._get. Checkpoint and cache reads and 
+        writes run in a worker thread so the event loop keeps serving 
+        other requests while SQLite or the disk is busy.
+        """
+        event = self._event(url, params)
+        try:
+            body = await asyncio.to_thread(self._stored, url, params, event, page)
+            if body is not None:
+                return self._seen(body)
+            key, flight, leader = self._flight(url, params, page)
+            if not leader:
+                event['cache'] = 'coalesced'
+                return self._seen(await asyncio.wrap_future(flight))
+            try:
+                body = await self._send(url, params, event, page)
+            except BaseException as e:
+                self._land(key).set_exception(e)
+                raise
+            self._land(key).set_result(body)
+            return self._seen(body)
+        except Exception as e:
+            event['error'] = type(e).__name__
+            raise
+        finally:
+            self._emit(event)
+
+    async def _send(self, url, params, event, page = False):
+        # aiohttp rejects None values and does not merge a query string 
+        # already on the url, both of which the endpoint methods produce.
+        bare, query = _split_url(url, params)
+        attempt = 0
+        while True:
+            self.retry.check()
+            event['waited'] += await self.rate_limiter.acquire_async()
+            status = retry_after = error = None
+            try:
+                async with self._client().get(bare, params = query, headers = self._header) as resp:
+                    status = event['status'] = resp.status
+                    if status in self.retry.RETRY_STATUSES:
+                        retry_after = resp.headers.get('Retry-After')
+                        error = aiohttp.ClientResponseError(resp.request_info, resp.history, 
+                                                            status = status, message = resp.reason)
+                    else:
+                        resp.raise_for_status()
+                        raw = await resp.read()
+                        event['bytes'] += len(raw)
+                        body = self._decode(raw)
+                        if page:
+                            error = self._empty_page(url, params, body)
+            except aiohttp.ClientResponseError:
+                raise
+            except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
+                error = e
+            if error is None:
+                self.retry.success()
+                await asyncio.to_thread(self._store, url, params, body)
+                return body
+            self.retry.failure()
+            if attempt >= self.retry.max_retries:
+                raise error
+            wait = self.retry.delay(attempt, retry_after)
+            if status == 429:
+                self.rate_limiter.pause(wait)
+            else:
+                await asyncio.sleep(wait)
+            attempt = event['retries'] = attempt + 1
+
+    async def _fetch_page(self, url, params, offset, sleep = 0):
+        results = (await self._get(url, dict(params or {}, offset = offset), page = True))['results']
+        if sleep:
+            await asyncio.sleep(sleep)
+        return results
+
+    def _collect(self, url, params = None, collect_all=False, sleep=0, df = False, 
+                 progress = False, stream = False):
+        """
+        Coroutine version of Noaa._collect. With stream=True an async 
+        generator of pages is returned instead, for use with async for.
+        """
+        if stream:
+            return self._stream(self._pages(url, params, collect_all = collect_all, sleep = sleep), df)
+        return self._gather(url, params, collect_all = collect_all, sleep = sleep, df = df)
+
+    async def _stream(self, pages, df = False):
+        async for results in pages:
+            yield self._frame(results, df) if df else results
+
+    async def _gather(self, url, params = None, collect_all=False, sleep=0, df = False):
+        pages = [results async for results in 
+                 self._pages(url, params, collect_all = collect_all, sleep = sleep)]
+        return self._join(pages, df)
+
+    async def _pages(self, url, params = None, collect_all=False, sleep=0, progress = False):
+        """
+        Async generator of each page of results, in offset order. The 
+        remaining pages of a collect_all crawl are requested concurrently, 
+        at most 2 * max_workers ahead of the consumer.
+        """
+        if not collect_all:
+            yield self._results(await self._get(url, params))
+            return
+
+        params = dict(params or {})
+        if params.get('limit') is None:
+            params['limit'] = MAX_LIMIT
+        call = await self._get(url, params)
+        if 'metadata' not in call:
+            yield self._results(call)
+            return
+        resultset = call['metadata']['resultset']
+        limit = resultset['limit']
+        first = max(resultset['offset'], 1)
+        yield call['results']
+
+        pending = deque()
+        try:
+            for offset in range(first + limit, resultset['count'] + 1, limit):
+                pending.append(asyncio.ensure_future(self._fetch_page(url, params, offset, sleep)))
+                if len(pending) >= 2 * self.max_workers:
+                    yield await pending.popleft()
+            while pending:
+                yield await pending.popleft()
+        finally:
+            for task in pending:
+                task.cancel()
+
+    def _collect_windows(self, url, params, windows, collect_all=False, sleep=0, df = False, 
+                         stream = False):
+        """Coroutine, or async generator if stream, version of Noaa._collect_windows."""
+        if stream:
+            return self._stream(self._window_pages(url, params, windows, collect_all, sleep), df)
+        return self._gather_windows(url, params, windows, collect_all = collect_all, 
+                                    sleep = sleep, df = df)
+
+    async def _window_pages(self, url, params, windows, collect_all=False, sleep=0):
+        for start, end in windows:
+            async for results in self._pages(url, dict(params, startdate = start, enddate = end), 
+                                             collect_all = collect_all, sleep = sleep):
+                yield results
+
+    async def _gather_windows(self, url, params, windows, collect_all=False, sleep=0, df = False):
+        pages = await asyncio.gather(*(
+            self._gather(url, dict(params, startdate = start, enddate = end), 
+                         collect_all = collect_all, sleep = sleep)
+            for start, end in windows))
+        return self._join(pages, df)
+
+    async def _collect_batch(self, calls, df = False):
+        pages = await asyncio.gather(*(self.data(**kwargs) for kwargs in calls))
+        return self._join(pages, df)
+
+    async def _write_parquet(self, pages, parquet, kind, dataset_id = None):
+        sink = parquet if isinstance(parquet, ParquetSink) else \
+               ParquetSink(parquet, kind = kind, dataset_id = dataset_id)
+        with sink:
+            async for results in pages:
+                sink.write(results)
+        return sink
+
+    async def sync(self, dataset_id, station_ids, state, start_date, end_date = None, 
+                   datatype_ids = None, units = None, check_stations = True, 
+                   location_id = None, df = False):
+        """Coroutine version of Noaa.sync."""
+        if not isinstance(state, SyncState):
+            state = SyncState(state)
+        end_date = end_date or dt.date.today().isoformat()
+        since = self._sync_since(dataset_id, station_ids, state, start_date, datatype_ids)
+        if check_stations and since:
+            since = await self._sync_check(dataset_id, since, end_date, datatype_ids, location_id)
+        results = await self._collect_batch(self._sync_calls(dataset_id, since, end_date, 
+                                                             datatype_ids, units))
+        return self._sync_commit(dataset_id, state, since, results, df)
+
+    async def _sync_check(self, dataset_id, since, end_date, datatype_ids = None, location_id = None):
+        """Coroutine version of Noaa._sync_check."""
+        listing, complete = [], False
+        for offset in self._sync_offsets(dataset_id, since, end_date, datatype_ids):
+            page = await self.stations(**self._sync_page(dataset_id, since, location_id, offset))
+            listing += page
+            if len(page) < MAX_LIMIT:
+                complete = True
+                break
+        return self._sync_due(since, listing, complete and location_id is None)
+
+
+
+class StationIndex(object):
+
+    def __init__(self, stations, noaa = None, query = None, max_age = 7 * 86400, 
+                 synced_at = None):
+        """
+        Local spatial index over a station catalogue.
+
+        Answers extent, radius and nearest station queries without 
+        touching the api. Stations are held in numpy arrays; latitude is 
+        kept sorted for bounding boxes and, when scipy is installed, a 
+        KD-tree over unit vectors serves radius and nearest queries 
+        (a vectorized scan is used otherwise). Build one with 
+        StationIndex.build(noaa, dataset_id = ...). If noaa is set the 
+        catalogue is pulled again once it is older than max_age.
+        ------------------------------------------------------------------
+        stations =      List of station records, as from 
+                        Noaa.stations(collect_all = True).
+        ------------------------------------------------------------------
+        noaa =          Client used to refresh a stale index.
+        ------------------------------------------------------------------
+        query =         dict of stations() arguments the catalogue was 
+                        pulled with, reused on refresh.
+        ------------------------------------------------------------------
+        max_age =       Seconds before the index is stale. Defaults to 
+                        a week. None never goes stale.
+        """
+        self.noaa = noaa
+        self.query = dict(query or {})
+        self.max_age = max_age
+        self._load(stations, synced_at)
+
+    @classmethod
+    def build(cls, noaa, max_age = 7 * 86400, **query):
+        """
+        Pull the full station catalogue with noaa.stations(**query, 
+        collect_all = True) and index it.
+        """
+        query.update(collect_all = True, df = False)
+        return cls(noaa.stations(**query), noaa = noaa, query = query, max_age = max_age)
+
+    def _load(self, stations, synced_at = None):
+        stations = [station for station in stations 
+                    if station.get('latitude') is not None and station.get('longitude') is not None]
+        order = sorted(range(len(stations)), key = lambda i: stations[i]['latitude'])
+        self.stations = [stations[i] for i in order]
+        self.synced_at = tm.time() if synced_at is None else synced_at
+        self.latitude = np.array([station['latitude'] for station in self.stations], dtype = float)
+        self.longitude = np.array([station['longitude'] for station in self.stations], dtype = float)
+        self.coverage = np.array([station.get('datacoverage') or 0 for station in self.stations], 
+                                 dtype = float)
+        self.mindate = np.array([station.get('mindate') or '' for station in self.stations])
+        self.maxdate = np.array([station.get('maxdate') or '' for station in self.stations])
+        self._xyz = self._unit(self.latitude, self.longitude)
+        self._tree = cKDTree(self._xyz) if cKDTree is not None and len(self.stations) else None
+
+    def __len__(self):
+        return len(self.stations)
+
+    @property
+    def stale(self):
+        return self.max_age is not None and tm.time() - self.synced_at > self.max_age
+
+    def refresh(self, force = False):
+        """Pull the catalogue again if the index is stale (or force)."""
+        if self.noaa is not None and (force or self.stale):
+            self._load(self.noaa.stations(**self.query))
+
+    @staticmethod
+    def _unit(latitude, longitude):
+        lat, lon = np.radians(latitude), np.radians(longitude)
+        return np.column_stack([np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat)])
+
+    def _mask(self, min_coverage = None, start_date = None, end_date = None):
+        """Same meaning as the stations() arguments: data after start_date, before end_date."""
+        mask = np.ones(len(self.stations), dtype = bool)
+        if min_coverage is not None:
+            mask &= self.coverage >= min_coverage
+        if start_date is not None:
+            mask &= self.maxdate >= start_date[:10]
+        if end_date is not None:
+            mask &= (self.mindate <= end_date[:10]) & (self.mindate != '')
+        return mask
+
+    def _records(self, index, distance = None, df = False):
+        records = [self.stations[i] for i in index]
+        if distance is not None:
+            records = [dict(record, distance = float(km)) for record, km in zip(records, distance)]
+        if df:
+            builder = FrameBuilder()
+            builder.add(records)
+            return builder.build()
+        return records
+
+    def extent(self, south, west = None, north = None, east = None, min_coverage = None, 
+               start_date = None, end_date = None, df = False):
+        """
+        Stations inside a bounding box. Accepts the four edges or a 
+        'south,west,north,east' string as taken by stations(extent = ...). 
+        Boxes crossing the antimeridian have west > east.
+        """
+        self.refresh()
+        if isinstance(south, str):
+            south, west, north, east = (float(edge) for edge in south.split(','))
+        lo = np.searchsorted(self.latitude, south, side = 'left')
+        hi = np.searchsorted(self.latitude, north, side = 'right')
+        lon = self.longitude[lo:hi]
+        inside = (lon >= west) & (lon <= east) if west <= east else (lon >= west) | (lon <= east)
+        inside &= self._mask(min_coverage, start_date, end_date)[lo:hi]
+        return self._records(lo + np.flatnonzero(inside), df = df)
+
+    def within(self, latitude, longitude, radius_km, min_coverage = None, 
+               start_date = None, end_date = None, df = False):
+        """Stations within radius_km of a point, nearest first, with a distance key."""
+        self.refresh()
+        point = self._unit(latitude, longitude)[0]
+        chord = 2 * np.sin(min(radius_km / EARTH_RADIUS_KM, np.pi) / 2)
+        if self._tree is not None:
+            index = np.array(self._tree.query_ball_point(point, chord), dtype = int)
+        else:
+            index = np.flatnonzero(np.linalg.norm(self._xyz - point, axis = 1) <= chord)
+        index = index[self._mask(min_coverage, start_date, end_date)[index]]
+        distance = self._distance(point, index)
+        order = np.argsort(distance)
+        return self._records(index[order], distance[order], df = df)
+
+    def nearest(self, latitude, longitude, k = 1, min_coverage = None, 
+                start_date = None, end_date = None, df = False):
+        """The k stations nearest a point, nearest first, with a distance key."""
+        self.refresh()
+        point = self._unit(latitude, longitude)[0]
+        mask = self._mask(min_coverage, start_date, end_date)
+        if self._tree is not None and mask.all():
+            _, index = self._tree.query(point, k = min(k, len(self.stations)))
+            index = np.atleast_1d(index)
+        else:
+            index = np.flatnonzero(mask)
+            distance = np.linalg.norm(self._xyz[index] - point, axis = 1)
+            if k < len(index):
+                index = index[np.argpartition(distance, k)[:k]]
+        distance = self._distance(point, index)
+        order = np.argsort(distance)
+        return self._records(index[order], distance[order], df = df)
+
+    def _distance(self, point, index):
+        """Great circle distance, in km, from point to the indexed stations."""
+        chord = np.linalg.norm(self._xyz[index] - point, axis = 1)
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.clip(chord / 2, 0, 1))
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(dict(synced_at = self.synced_at, query = self.query, 
+                           stations = self.stations), f)
+
+    @classmethod
+    def load(cls, path, noaa = None, max_age = 7 * 86400):
+        with open(path) as f:
+            saved = json.load(f)
+        return cls(saved['stations'], noaa = noaa, query = saved['query'], 
+                   max_age = max_age, synced_at = saved['synced_at'])
+
+
+class NoaaCatalog(object):
+
+    # Catalogue name of each metadata endpoint and the Noaa method listing it.
+    ENDPOINTS = dict(datasets = 'datasets', datacategories = 'data_category', 
+                     datatypes = 'data_types', locationcategories = 'location_categories', 
+                     locations = 'locations')
+
+    def __init__(self, path = 'noaa_catalog.sqlite', noaa = None, max_age = 7 * 86400):
+        """
+        Local snapshot of the CDO metadata endpoints.
+
+        Records of datasets, data categories, data types, location 
+        categories and locations are kept in a SQLite file, together 
+        with the links the api only answers through filtered listings: 
+        the data types of each dataset and, for the locations indexed 
+        with index_locations(), their stations and data types. On load 
+        they are held in dicts and sets, so lookups such as "which data 
+        types does dataset X have at location Y" need no request. 
+        refresh() pulls again only the parts older than max_age, and 
+        prune() checks a data() query against the catalogue before it 
+        is sent.
+        ------------------------------------------------------------------
+        path =          SQLite file of the catalogue.
+        ------------------------------------------------------------------
+        noaa =          Client used by refresh() and index_locations().
+        ------------------------------------------------------------------
+        max_age =       Seconds before a part of the catalogue is pulled 
+                        again. Defaults to a week.
+        """
+        self.path = path
+        self.noaa = noaa
+        self.max_age = max_age
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout = 30, check_same_thread = False, 
+                                   isolation_level = None)
+        self._db.execute('CREATE TABLE IF NOT EXISTS records ('
+                         'endpoint TEXT, id TEXT, body TEXT, PRIMARY KEY (endpoint, id))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS links ('
+                         'kind TEXT, dataset TEXT, parent TEXT, child TEXT, '
+                         'PRIMARY KEY (kind, dataset, parent, child))')
+        self._db.execute('CREATE TABLE IF NOT EXISTS scopes (scope TEXT PRIMARY KEY, synced_at REAL)')
+        self._load()
+
+    def _load(self):
+        with self._lock:
+            self.records = {}
+            for endpoint, id_, body in self._db.execute('SELECT endpoint, id, body FROM records'):
+                self.records.setdefault(endpoint, {})[id_] = json.loads(body)
+            self.links = {}
+            for kind, dataset, parent, child in self._db.execute(
+                    'SELECT kind, dataset, parent, child FROM links'):
+                self.links.setdefault((kind, dataset, parent), set()).add(child)
+            self.synced = dict(self._db.execute('SELECT scope, synced_at FROM scopes'))
+
+    def _stale(self, scope, force = False):
+        synced_at = self.synced.get(scope)
+        return force or synced_at is None or \
+               (self.max_age is not None and tm.time() - synced_at > self.max_age)
+
+    def _save(self, scope, endpoint = None, records = None, links = None, replace = False):
+        """
+        Store one pulled scope in a single transaction: records of 
+        endpoint (all of the endpoint's records if replace) and the 
+        {(kind, dataset, parent): children} links, which replace the 
+        children stored before.
+        """
+        records = [record for record in records or [] if 'id' in record]
+        links = links or {}
+        synced_at = tm.time()
+        with self._lock:
+            self._db.execute('BEGIN')
+            try:
+                if endpoint is not None:
+                    if replace:
+                        self._db.execute('DELETE FROM records WHERE endpoint = ?', (endpoint,))
+                    self._db.executemany('INSERT OR REPLACE INTO records VALUES (?, ?, ?)', 
+                                         [(endpoint, record['id'], json.dumps(record)) 
+                                          for record in records])
+                for (kind, dataset, parent), children in links.items():
+                    self._db.execute('DELETE FROM links WHERE kind = ? AND dataset = ? AND parent = ?', 
+                                     (kind, dataset, parent))
+                    self._db.executemany('INSERT OR IGNORE INTO links VALUES (?, ?, ?, ?)', 
+                                         [(kind, dataset, parent, child) for child in children])
+                self._db.execute('INSERT OR REPLACE INTO scopes VALUES (?, ?)', (scope, synced_at))
+                self._db.execute('COMMIT')
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            if endpoint is not None:
+                stored = self.records.setdefault(endpoint, {})
+                if replace:
+                    stored.clear()
+                stored.update((record['id'], record) for record in records)
+            for key, children in links.items():
+                self.links[key] = set(children)
+            self.synced[scope] = synced_at
+
+    def _client(self):
+        if self.noaa is None:
+            raise ValueError('NoaaCatalog needs a Noaa client to pull from')
+        return self.noaa
+
+    def refresh(self, force = False):
+        """
+        Pull every metadata endpoint, and the data types of every 
+        dataset, whose snapshot is older than max_age (or all, if 
+        force), then the indexed locations that went stale. Returns 
+        the scopes pulled.
+        """
+        noaa = self._client()
+        pulled = []
+        for endpoint, method in self.ENDPOINTS.items():
+            if self._stale(endpoint, force):
+                records = getattr(noaa, method)(collect_all = True)
+                self._save(endpoint, endpoint, records, replace = True)
+                pulled.append(endpoint)
+        for dataset_id in sorted(self.records.get('datasets', {})):
+            scope = f'datatypes:{dataset_id}'
+            if self._stale(scope, force):
+                records = noaa.data_types(dataset_id = dataset_id, collect_all = True)
+                self._save(scope, links = {('datatypes', dataset_id, ''): 
+                                           [record['id'] for record in records]})
+                pulled.append(scope)
+        stale = {}
+        for scope in self.synced:
+            if scope.startswith('location:') and self._stale(scope, force):
+                _, dataset_id, location_id = scope.split(':', 2)
+                stale.setdefault(dataset_id, []).append(location_id)
+        for dataset_id, location_ids in stale.items():
+            pulled += self.index_locations(location_ids, dataset_id or None, force = True)
+        return pulled
+
+    def index_locations(self, location_ids, dataset_id = None, force = False):
+        """
+        Pull the stations and data types of each location (within 
+        dataset_id, if given) so location lookups can be answered 
+        locally. Station records are kept too. Locations indexed less 
+        than max_age ago are skipped unless force. Returns the scopes 
+        pulled.
+        """
+        noaa = self._client()
+        dataset = dataset_id or ''
+        pulled = []
+        for location_id in location_ids:
+            scope = f'location:{dataset}:{location_id}'
+            if not self._stale(scope, force):
+                continue
+            stations = noaa.stations(location_id = location_id, dataset_id = dataset_id, 
+                                     collect_all = True)
+            datatypes = noaa.data_types(location_id = location_id, dataset_id = dataset_id, 
+                                        collect_all = True)
+            self._save(scope, 'stations', stations, links = {
+                ('stations', dataset, location_id): [record['id'] for record in stations],
+                ('datatypes', dataset, location_id): [record['id'] for record in datatypes]})
+            pulled.append(scope)
+        return pulled
+
+    def get(self, endpoint, id_):
+        """The stored record of id_ ('datasets', 'datatypes', 'stations', ...), or None."""
+        return self.records.get(endpoint, {}).get(id_)
+
+    def datasets(self):
+        return sorted(self.records.get('datasets', {}))
+
+    def datatypes(self, dataset_id = None, location_id = None):
+        """
+        Ids of the data types of dataset_id, at location_id. Raises 
+        KeyError if that part of the catalogue was never pulled.
+        """
+        if location_id is not None:
+            key = ('datatypes', dataset_id or '', location_id)
+            if key not in self.links and f'location:{dataset_id or ""}:{location_id}' not in self.synced:
+                raise KeyError(f'{location_id} is not indexed, see index_locations()')
+            return sorted(self.links.get(key, ()))
+        if dataset_id is not None:
+            key = ('datatypes', dataset_id, '')
+            if key not in self.links and f'datatypes:{dataset_id}' not in self.synced:
+                raise KeyError(f'No data types of {dataset_id} in the catalogue, see refresh()')
+            return sorted(self.links.get(key, ()))
+        return sorted(self.records.get('datatypes', {}))
+
+    def stations(self, location_id, dataset_id = None):
+        """Ids of the stations at location_id. Raises KeyError if not indexed."""
+        key = ('stations', dataset_id or '', location_id)
+        if key not in self.links and f'location:{dataset_id or ""}:{location_id}' not in self.synced:
+            raise KeyError(f'{location_id} is not indexed, see index_locations()')
+        return sorted(self.links.get(key, ()))
+
+    def coverage(self, datatype_id):
+        """(mindate, maxdate, datacoverage) of a data type, or None."""
+        record = self.get('datatypes', datatype_id)
+        if record is None:
+            return None
+        return record.get('mindate'), record.get('maxdate'), record.get('datacoverage')
+
+    def prune(self, dataset_id, start_date, end_date, datatype_id = None, 
+              station_id = None, **query):
+        """
+        Check a data() query against the catalogue and narrow it to 
+        what can return data: the dates are clipped to the dataset's 
+        range, data types the dataset lacks or whose dates miss the 
+        range are dropped, as are known stations whose dates miss it. 
+        Returns the data() keyword arguments, or None if nothing is 
+        left to ask for. Raises ValueError for an unknown dataset.
+        Parts of the catalogue not pulled yet are not checked.
+        """
+        datasets = self.records.get('datasets')
+        if datasets is not None and dataset_id not in datasets:
+            raise ValueError(f'Unknown dataset {dataset_id!r}')
+        dataset = (datasets or {}).get(dataset_id, {})
+        if dataset.get('mindate') and start_date[:10] < dataset['mindate'][:10]:
+            start_date = dataset['mindate'][:10]
+        if dataset.get('maxdate') and end_date[:10] > dataset['maxdate'][:10]:
+            end_date = dataset['maxdate'][:10]
+        if start_date[:10] > end_date[:10]:
+            return None
+
+        def overlaps(record):
+            return record is None or ((record.get('maxdate') or '9999')[:10] >= start_date[:10] 
+                                      and (record.get('mindate') or '')[:10] <= end_date[:10])
+
+        if datatype_id is not None:
+            known = self.links.get(('datatypes', dataset_id, ''))
+            ids = [datatype_id] if isinstance(datatype_id, str) else list(datatype_id)
+            ids = [id_ for id_ in ids if (known is None or id_ in known) 
+                   and overlaps(self.get('datatypes', id_))]
+            if not ids:
+                return None
+            datatype_id = ids[0] if isinstance(datatype_id, str) else ids
+        if station_id is not None:
+            ids = [station_id] if isinstance(station_id, str) else list(station_id)
+            ids = [id_ for id_ in ids if overlaps(self.get('stations', id_))]
+            if not ids:
+                return None
+            station_id = ids[0] if isinstance(station_id, str) else ids
+        return dict(query, dataset_id = dataset_id, start_date = start_date, end_date = end_date, 
+                    datatype_id = datatype_id, station_id = station_id)
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class QueryPlan(object):
+
+    def __init__(self, endpoint, calls, requests, rows, per_second, quota_remaining, exact, 
+                 probe_requests = 0, min_requests = None):
+        """
+        What running a Query will cost. calls is the number of endpoint 
+        calls (station groups) it is split into, requests the pages 
+        they fetch over all date windows, rows the records expected and 
+        seconds the wall time at the rate limiter's pace. When the row 
+        count can not be estimated (locations, metadata endpoints) 
+        requests, rows and seconds are None, fits_quota is None unless 
+        min_requests, the first page of every window, already exceeds 
+        the quota; plan(probe = True) gives the real numbers. exact is 
+        True when the counts come from a probe rather than an 
+        estimate; probe_requests is what the probe spent. Plans add up 
+        (sum() works too), so a scheduler can price a set of queries.
+        """
+        self.endpoint = endpoint
+        self.calls = calls
+        self.requests = requests
+        self.min_requests = requests if min_requests is None else min_requests
+        self.rows = rows
+        self.per_second = per_second
+        self.quota_remaining = quota_remaining
+        self.exact = exact
+        self.probe_requests = probe_requests
+
+    @property
+    def seconds(self):
+        return None if self.requests is None else self.requests / self.per_second
+
+    @property
+    def fits_quota(self):
+        if self.min_requests > self.quota_remaining:
+            return False
+        return None if self.requests is None else self.requests <= self.quota_remaining
+
+    def __add__(self, other):
+        def total(a, b):
+            return None if a is None or b is None else a + b
+
+        endpoint = self.endpoint if self.endpoint == other.endpoint else 'mixed'
+        return QueryPlan(endpoint, self.calls + other.calls, total(self.requests, other.requests), 
+                         total(self.rows, other.rows), min(self.per_second, other.per_second), 
+                         min(self.quota_remaining, other.quota_remaining), 
+                         self.exact and other.exact, self.probe_requests + other.probe_requests, 
+                         self.min_requests + other.min_requests)
+
+    def __radd__(self, other):
+        return self if other == 0 else NotImplemented
+
+    def __repr__(self):
+        if self.requests is None:
+            cost = f'{self.min_requests}+ requests, unknown rows, unknown time'
+        else:
+            cost = f'{self.requests} requests, {self.rows} rows, {self.seconds:.1f}s'
+        quota = {True: 'ok', False: 'exceeded', None: 'unknown'}[self.fits_quota]
+        return (f'<QueryPlan {self.endpoint}: {self.calls} calls, {cost}, quota {quota}'
+                f'{"" if self.exact else ", estimated"}>')
+
+
+class Query(object):
+
+    def __init__(self, noaa, endpoint, kwargs):
+        """
+        A deferred call of one Noaa endpoint method. Builder methods 
+        return a new Query with the argument changed; nothing is sent 
+        until collect(), stream() or to_parquet(), and plan() tells 
+        what that will cost first:
+
+            query = noaa.query.data('GHCND').stations(ids).between(a, b)
+            if query.plan().fits_quota:
+                frame = query.collect(df = True)
+
+        Station lists longer than one request can chain are split 
+        into groups as in data_batch().
+        """
+        self.noaa = noaa
+        self.endpoint = endpoint
+        self.kwargs = dict(kwargs)
+
+    def where(self, **kwargs):
+        """Same query with the given endpoint arguments set."""
+        return type(self)(self.noaa, self.endpoint, dict(self.kwargs, **kwargs))
+
+    def between(self, start_date, end_date):
+        return self.where(start_date = start_date, end_date = end_date)
+
+    def datatypes(self, datatype_ids):
+        return self.where(datatype_id = datatype_ids)
+
+    def locations(self, location_ids):
+        return self.where(location_id = location_ids)
+
+    def __repr__(self):
+        args = ', '.join(f'{key}={value!r}' for key, value in self.kwargs.items() 
+                         if value is not None)
+        return f'<Query {self.endpoint}({args})>'
+
+    def _calls(self):
+        return [dict(self.kwargs)]
+
+    def _method(self, noaa = None):
+        return getattr(noaa or self.noaa, self.endpoint)
+
+    def _estimate(self, call):
+        """Rows expected from one call, per date window, or None if unknown."""
+        return None
+
+    def _probe(self, call):
+        """Rows one call returns per date window, asked for with limit=1 requests."""
+        if isinstance(self.noaa, AsyncNoaa):
+            raise TypeError('Probing needs a synchronous Noaa client')
+        bodies = []
+        # Probe pages are not part of any crawl, keep them out of the 
+        # checkpoint, and one window at a time keeps bodies in order.
+        client = self.noaa._clone(checkpoint = None, max_workers = 1, _on_body = bodies.append)
+        self._method(client)(**dict(call, limit = 1, collect_all = False))
+        return [body['metadata']['resultset']['count'] if 'metadata' in body else 
+                len(client._results(body)) for body in bodies]
+
+    def _windows(self, call):
+        return 1
+
+    def plan(self, probe = False):
+        """
+        QueryPlan of the query. Estimated from the dataset's record 
+        frequency and the number of stations and data types unless 
+        probe, which spends one small request per call and date 
+        window to read the exact counts. Without a probe the cost of 
+        location and metadata queries is unknown (None).
+        """
+        limit = self.kwargs.get('limit') or MAX_LIMIT
+        calls = self._calls()
+        requests = rows = probed = 0
+        known = True
+        for call in calls:
+            counts = self._probe(call) if probe else self._estimate(call)
+            if counts is None:
+                # Only the first page of each window is certain
+                requests += self._windows(call)
+                known = False
+                continue
+            probed += len(counts) if probe else 0
+            requests += sum(max(1, -(-count // limit)) for count in counts)
+            rows += sum(counts)
+        limiter = self.noaa.rate_limiter
+        if not known:
+            return QueryPlan(self.endpoint, len(calls), None, None, limiter.per_second, 
+                             limiter.remaining, False, probed, min_requests = requests)
+        return QueryPlan(self.endpoint, len(calls), requests, rows, limiter.per_second, 
+                         limiter.remaining, probe, probed)
+
+    def collect(self, df = False):
+        """Run the query, fetching every page. A coroutine on AsyncNoaa."""
+        calls = [dict(call, collect_all = True) for call in self._calls()]
+        if len(calls) == 1:
+            return self._method()(**calls[0], df = df)
+        return self.noaa._collect_batch(calls, df)
+
+    def stream(self, df = False):
+        """Run the query, yielding each page as it arrives."""
+        calls = [dict(call, collect_all = True, df = df, stream = True) for call in self._calls()]
+        if isinstance(self.noaa, AsyncNoaa):
+            return self._astream(calls)
+        return (results for call in calls for results in self._method()(**call))
+
+    async def _astream(self, calls):
+        for call in calls:
+            async for results in self._method()(**call):
+                yield results
+
+    def to_parquet(self, parquet):
+        """
+        Run the query into a Parquet dataset (a directory or a 
+        ParquetSink) and return the sink. data and stations only.
+        """
+        if self.endpoint not in ('data', 'stations'):
+            raise ValueError(f'{self.endpoint} results can not be written to Parquet')
+        if not isinstance(parquet, ParquetSink):
+            parquet = ParquetSink(parquet, kind = self.endpoint, 
+                                  dataset_id = self.kwargs.get('dataset_id'))
+        # A coroutine on AsyncNoaa, like the endpoint methods
+        return self.noaa._write_parquet(self.stream(), parquet, self.endpoint)
+
+
+class DataQuery(Query):
+
+    def stations(self, station_ids):
+        return self.where(station_id = station_ids)
+
+    def units(self, units):
+        return self.where(units = units)
+
+    def _calls(self):
+        station_ids = self.kwargs.get('station_id')
+        if station_ids is None or isinstance(station_ids, str):
+            return [dict(self.kwargs)]
+        groups = self.noaa._plan_batch(self.kwargs['dataset_id'], station_ids, 
+                                       self.kwargs['start_date'], self.kwargs['end_date'], 
+                                       self._datatype_ids())
+        return [dict(self.kwargs, station_id = group) for group in groups]
+
+    def _datatype_ids(self):
+        datatype_ids = self.kwargs.get('datatype_id')
+        return [datatype_ids] if isinstance(datatype_ids, str) else datatype_ids
+
+    def _windows(self, call):
+        return len(self.noaa._date_windows(call['dataset_id'], call['start_date'], 
+                                           call['end_date']))
+
+    def _estimate(self, call):
+        station_ids = call.get('station_id')
+        if station_ids is None:
+            # A location or the whole dataset; the station count is unknown
+            return None
+        stations = 1 if isinstance(station_ids, str) else len(station_ids)
+        datatypes = len(self._datatype_ids() or []) or DEFAULT_DATATYPES
+        counts = []
+        for start, end in self.noaa._date_windows(call['dataset_id'], call['start_date'], 
+                                                  call['end_date']):
+            days = (dt.date.fromisoformat(end[:10]) - dt.date.fromisoformat(start[:10])).days + 1
+            records = max(1, round(days / RECORD_DAYS.get(call['dataset_id'], 1)))
+            counts.append(records * datatypes * stations)
+        return counts
+
+
+class QueryBuilder(object):
+
+    def __init__(self, noaa):
+        """
+        Makes deferred Query objects for noaa's endpoint methods, e.g. 
+        noaa.query.data('GHCND').stations(ids).between(a, b) or 
+        noaa.query.stations(dataset_id = 'GHCND'). Arguments are those 
+        of the endpoint method.
+        """
+        self.noaa = noaa
+
+    def data(self, dataset_id, start_date = None, end_date = None, **kwargs):
+        return DataQuery(self.noaa, 'data', dict(kwargs, dataset_id = dataset_id, 
+                                                 start_date = start_date, end_date = end_date))
+
+    def __getattr__(self, endpoint):
+        if endpoint not in ('datasets', 'data_category', 'data_types', 'location_categories', 
+                            'locations', 'stations'):
+            raise AttributeError(endpoint)
+        return lambda **kwargs: Query(self.noaa, endpoint, kwargs)
+
+
+def _backfill_worker(worker, spec, path, dataset_id, tasks, results):
+    """
+    Body of one Backfill worker process: fetch each unit put on tasks 
+    with its own client and write it to the shared Parquet dataset. 
+    Reports (worker, unit, status, rows, requests, error) on results.
+    """
+    limiter = RateLimiter(spec['per_second'], spec['per_day'])
+    with Noaa(spec['api_key'], base_url = spec['base_url'], max_workers = spec['max_workers'], 
+              max_retries = spec['max_retries'], timeout = spec['timeout'], 
+              rate_limiter = limiter) as noaa:
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            unit, call = task
+            remaining = limiter.remaining
+            try:
+                # Progress is reported by the parent
+                records = noaa.data(collect_all = True, progress = False, **call)
+                # Written only once the whole unit is in, so a failed unit 
+                # leaves nothing behind to duplicate on a rerun.
+                with ParquetSink(path, kind = 'data', dataset_id = dataset_id) as sink:
+                    sink.write(records)
+            except QuotaExceeded:
+                results.put((worker, unit, 'quota', 0, remaining - limiter.remaining, None))
+                return
+            except Exception as e:
+                results.put((worker, unit, 'error', 0, remaining - limiter.remaining, repr(e)))
+            else:
+                results.put((worker, unit, 'done', len(records), 
+                             remaining - limiter.remaining, None))
+
+
+class Backfill(object):
+
+    def __init__(self, clients, dataset_id, station_ids, start_date, end_date, path, 
+                 datatype_ids = None, units = None, rows_per_station = None, prefetch = 2):
+        """
+        Runs one large data() job across several api tokens at once.
+
+        The job is split into work units, each a chained group of 
+        stations (as in data_batch()) over one date window, and spread 
+        over one worker process per token. Every worker paces its own 
+        requests and stops at its own daily quota. Units are sharded 
+        between the workers up front; a worker that runs dry steals from 
+        the back of the busiest worker's queue, and the units of a 
+        worker that hits its quota or dies are handed to the others. 
+        Finished units are written to a shared hive partitioned Parquet 
+        dataset (see ParquetSink) and journaled beside it, so a rerun 
+        only fetches the units still missing. Requires pyarrow.
+
+            backfill = Backfill([token_a, token_b, token_c], 'GHCND', 
+                                station_ids, '1990-01-01', '2019-12-31', 
+                                'ghcnd/')
+            summary = backfill.run()
+        ------------------------------------------------------------------
+        clients =          Noaa clients or api tokens, one worker each. 
+                           A client's base_url, max_workers, retries, 
+                           rate limit and remaining quota carry over to 
+                           its worker.
+        ------------------------------------------------------------------
+        dataset_id =       REQUIRED. A single valid dataset id.
+        ------------------------------------------------------------------
+        station_ids =      REQUIRED. A list of station ids.
+        ------------------------------------------------------------------
+        start_date =       REQUIRED. ISO formated date (YYYY-MM-DD).
+        ------------------------------------------------------------------
+        end_date =         REQUIRED. ISO formated date (YYYY-MM-DD).
+        ------------------------------------------------------------------
+        path =             REQUIRED. Root directory of the dataset.
+        ------------------------------------------------------------------
+        datatype_ids =     A list of data type ids. If None, all data 
+                           types are fetched.
+        ------------------------------------------------------------------
+        units =            'standard' or 'metric'. See data().
+        ------------------------------------------------------------------
+        rows_per_station = Sizes the station groups. See data_batch().
+        ------------------------------------------------------------------
+        prefetch =         Units queued ahead on each worker. Defaults 
+                           to 2.
+        """
+        if pa is None:
+            raise ImportError('Backfill requires pyarrow: pip install pyarrow')
+        self.specs = [self._spec(client) for client in clients]
+        if not self.specs:
+            raise ValueError('Backfill needs at least one client or token')
+        self.dataset_id = dataset_id
+        self.path = path
+        self.prefetch = prefetch
+        self.units = self._plan(dataset_id, station_ids, start_date, end_date, 
+                                datatype_ids, units, rows_per_station)
+        job = json.dumps([dataset_id, sorted(station_ids), start_date, end_date, 
+                          datatype_ids, units], sort_keys = True)
+        # pyarrow skips files starting with an underscore when reading the dataset
+        self.journal = os.path.join(path, f'_backfill-{hashlib.sha1(job.encode()).hexdigest()[:12]}')
+
+    @staticmethod
+    def _spec(client):
+        if isinstance(client, Noaa):
+            return dict(api_key = client._api_key, base_url = client.base_url, 
+                        max_workers = client.max_workers, max_retries = client.retry.max_retries, 
+                        timeout = client._timeout, per_second = client.rate_limiter.per_second, 
+                        per_day = client.rate_limiter.remaining)
+        limiter = RateLimiter()
+        return dict(api_key = client, base_url = None, max_workers = 5, max_retries = 3, 
+                    timeout = 30, per_second = limiter.per_second, per_day = limiter.per_day)
+
+    def _plan(self, dataset_id, station_ids, start_date, end_date, datatype_ids, units, 
+              rows_per_station):
+        """The data() keyword arguments of every (station group, window) unit."""
+        planner = Noaa(self.specs[0]['api_key'], base_url = self.specs[0]['base_url'])
+        with planner:
+            groups = planner._plan_batch(dataset_id, station_ids, start_date, end_date, 
+                                         datatype_ids, rows_per_station)
+            windows = planner._date_windows(dataset_id, start_date, end_date)
+        return [dict(dataset_id = dataset_id, start_date = start, end_date = end, 
+                     station_id = group, datatype_id = datatype_ids, units = units)
+                for start, end in windows for group in groups]
+
+    @staticmethod
+    def _key(call):
+        return f"{call['start_date']}|{call['end_date']}|{','.join(call['station_id'])}"
+
+    def done(self):
+        """Keys of the units finished by this or an earlier run."""
+        try:
+            with open(self.journal) as f:
+                return set(line.rstrip('\n') for line in f)
+        except FileNotFoundError:
+            return set()
+
+    def run(self, progress = True):
+        """
+        Fetch every unit not yet done and return a summary dict: units 
+        done, failed and left, rows, requests, steals, seconds, and the 
+        same counts per worker. Units that failed or were left over 
+        (every quota used up) are fetched by the next run.
+        """
+        os.makedirs(self.path, exist_ok = True)
+        finished = self.done()
+        todo = [unit for unit, call in enumerate(self.units) if self._key(call) not in finished]
+        n = len(self.specs)
+        size = -(-len(todo) // n) if todo else 0
+        shards = [deque(todo[i * size:(i + 1) * size]) for i in range(n)]
+        summary = dict(units = len(self.units), skipped = len(self.units) - len(todo), done = 0, 
+                       failed = 0, left = 0, rows = 0, requests = 0, steals = 0, seconds = 0.0, 
+                       errors = [], workers = [dict(units = 0, rows = 0, requests = 0, 
+                                                    status = 'running') for _ in range(n)])
+        started = tm.perf_counter()
+
+        ctx = mp.get_context()
+        results = ctx.Queue()
+        tasks = [ctx.Queue() for _ in range(n)]
+        processes = [ctx.Process(target = _backfill_worker, daemon = True,
+                                 args = (i, spec, self.path, self.dataset_id, tasks[i], results))
+                     for i, spec in enumerate(self.specs)]
+        for process in processes:
+            process.start()
+        live = set(range(n))
+        outstanding = [set() for _ in range(n)]
+
+        def feed(worker):
+            while len(outstanding[worker]) < self.prefetch:
+                if shards[worker]:
+                    unit = shards[worker].popleft()
+                else:
+                    # Steal from the back of the fullest queue
+                    victim = max(range(n), key = lambda i: len(shards[i]))
+                    if not shards[victim]:
+                        return
+                    unit = shards[victim].pop()
+                    summary['steals'] += 1
+                outstanding[worker].add(unit)
+                tasks[worker].put((unit, self.units[unit]))
+
+        def retire(worker, status):
+            # Hand the worker's queued and unfinished units to the others
+            live.discard(worker)
+            summary['workers'][worker]['status'] = status
+            orphans = sorted(outstanding[worker]) + list(shards[worker])
+            outstanding[worker].clear()
+            shards[worker].clear()
+            if live:
+                target = min(live, key = lambda i: len(shards[i]))
+                shards[target].extendleft(reversed(orphans))
+                for i in live:
+                    feed(i)
+            else:
+                summary['left'] += len(orphans)
+
+        with open(self.journal, 'a') as journal:
+            for worker in range(n):
+                feed(worker)
+            try:
+                while any(outstanding):
+                    try:
+                        worker, unit, status, rows, requests, error = results.get(timeout = 1)
+                    except queue.Empty:
+                        for worker in list(live):
+                            if not processes[worker].is_alive():
+                                retire(worker, 'died')
+                        continue
+                    if worker not in live and status != 'done':
+                        # Already retired as dead; its units were handed out
+                        continue
+                    stats = summary['workers'][worker]
+                    stats['requests'] += requests
+                    summary['requests'] += requests
+                    outstanding[worker].discard(unit)
+                    if status == 'done':
+                        journal.write(self._key(self.units[unit]) + '\n')
+                        journal.flush()
+                        stats['units'] += 1
+                        stats['rows'] += rows
+                        summary['done'] += 1
+                        summary['rows'] += rows
+                    elif status == 'error':
+                        summary['failed'] += 1
+                        summary['errors'].append((self._key(self.units[unit]), error))
+                    if status == 'quota':
+                        outstanding[worker].add(unit)
+                        retire(worker, 'quota')
+                    elif worker in live:
+                        feed(worker)
+                    if progress:
+                        self._progress(summary, len(todo), started)
+            finally:
+                for i in range(n):
+                    tasks[i].put(None)
+                for process in processes:
+                    process.join(timeout = 5)
+                    if process.is_alive():
+                        process.terminate()
+        for worker in live:
+            summary['workers'][worker]['status'] = 'done'
+        summary['seconds'] = tm.perf_counter() - started
+        if progress:
+            print()
+        return summary
+
+    def _progress(self, summary, total, started):
+        seconds = tm.perf_counter() - started
+        finished = summary['done'] + summary['failed']
+        print(f"\r{finished}/{total} units | {summary['rows']} rows | "
+              f"{summary['requests']} requests | {summary['rows'] / max(seconds, 1e-9):.0f} rows/s | "
+              f"{len([w for w in summary['workers'] if w['status'] == 'running'])} workers | "
+              f"{summary['steals']} steals", end = '')
@@ -0,0 +1,256 @@
+"""
+Local stand-in for the NOAA CDO v2 web services, for benchmarks.
+
+Serves /datasets, /datacategories, /datatypes, /locationcategories,
+/locations, /stations and /data (plus /<endpoint>/<id> lookups) under
+/cdo-web/api/v2 with the same paging metadata as the real api. Data
+rows are generated on the fly from the query, one per day x station x
+datatype, so million row crawls cost no memory on the server side.
+
+    with MockServer(latency = 0.05, error_rate = 0.01) as server:
+        noaa = Noaa('token', base_url = server.base_url)
+
+Run it on its own with:  python benchmarks/mock_server.py --port 8000
+"""
+import argparse
+import datetime as dt
+import json
+import random
+import threading
+import time as tm
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs
+
+
+PREFIX = '/cdo-web/api/v2'
+
+DATASETS = [dict(uid = 'gov.noaa.ncdc:C00861', id = 'GHCND', name = 'Daily Summaries',
+                 mindate = '1763-01-01', maxdate = '2024-12-31', datacoverage = 1),
+            dict(uid = 'gov.noaa.ncdc:C00946', id = 'GSOM', name = 'Global Summary of the Month',
+                 mindate = '1763-01-01', maxdate = '2024-12-01', datacoverage = 1),
+            dict(uid = 'gov.noaa.ncdc:C00947', id = 'GSOY', name = 'Global Summary of the Year',
+                 mindate = '1763-01-01', maxdate = '2024-01-01', datacoverage = 1)]
+
+DATACATEGORIES = [dict(id = 'TEMP', name = 'Air Temperature'),
+                  dict(id = 'PRCP', name = 'Precipitation')]
+
+DATATYPES = [dict(id = 'TMAX', name = 'Maximum temperature', datacoverage = 1,
+                  mindate = '1763-01-01', maxdate = '2024-12-31'),
+             dict(id = 'TMIN', name = 'Minimum temperature', datacoverage = 1,
+                  mindate = '1763-01-01', maxdate = '2024-12-31'),
+             dict(id = 'PRCP', name = 'Precipitation', datacoverage = 1,
+                  mindate = '1763-01-01', maxdate = '2024-12-31')]
+
+LOCATIONCATEGORIES = [dict(id = 'CITY', name = 'City'), dict(id = 'ST', name = 'State')]
+
+LOCATIONS = [dict(id = f'FIPS:{i:02d}', name = f'State {i}', datacoverage = 1,
+                  mindate = '1763-01-01', maxdate = '2024-12-31') for i in range(1, 57)]
+
+# Days covered by one record, by dataset.
+STEP = dict(GSOM = 'month', GSOY = 'year')
+
+
+class MockServer(object):
+
+    def __init__(self, host = '127.0.0.1', port = 0, latency = 0.0, error_rate = 0.0,
+                 rate_limit = None, max_limit = 1000, n_stations = 1000,
+                 default_datatypes = 2, seed = 0):
+        """
+        ------------------------------------------------------------------
+        latency =           Seconds added to every response.
+        ------------------------------------------------------------------
+        error_rate =        Fraction of requests answered with a 503.
+        ------------------------------------------------------------------
+        rate_limit =        Requests per second allowed before answering
+                            429 with a Retry-After. None disables it.
+        ------------------------------------------------------------------
+        max_limit =         Largest page size served.
+        ------------------------------------------------------------------
+        n_stations =        Size of the generated station catalogue.
+        ------------------------------------------------------------------
+        default_datatypes = Datatypes per station and day when a data
+                            query names none.
+        """
+        self.host = host
+        self.port = port
+        self.latency = latency
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+        self.max_limit = max_limit
+        self.default_datatypes = default_datatypes
+        self.requests = 0
+        self.errors = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._window = []
+        self.stations = [self._station(i) for i in range(n_stations)]
+        self._server = None
+
+    def _station(self, i):
+        lat = round(self._random.uniform(-60, 70), 4)
+        lon = round(self._random.uniform(-180, 180), 4)
+        return dict(id = f'GHCND:MOCK{i:07d}', name = f'MOCK STATION {i}',
+                    latitude = lat, longitude = lon, elevation = round(self._random.uniform(0, 3000), 1),
+                    elevationUnit = 'METERS', mindate = '1950-01-01',
+                    maxdate = '2024-12-31', datacoverage = round(self._random.random(), 4))
+
+    @property
+    def base_url(self):
+        return f'http://{self.host}:{self.port}{PREFIX}'
+
+    def start(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                status, body, headers = server.handle(self.path)
+                payload = json.dumps(body).encode() if body is not None else b''
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                for key, value in headers.items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(payload)
+
+        self._server = ThreadingHTTPServer((self.host, self.port), Handler)
+        self._server.daemon_threads = True
+        self.port = self._server.server_port
+        threading.Thread(target = self._server.serve_forever, daemon = True).start()
+        return self
+
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+    def reset(self):
+        with self._lock:
+            self.requests = 0
+            self.errors = 0
+            self._window = []
+
+    def _throttled(self):
+        now = tm.monotonic()
+        with self._lock:
+            self.requests += 1
+            if self.rate_limit is None:
+                return False
+            self._window = [t for t in self._window if now - t < 1] + [now]
+            return len(self._window) > self.rate_limit
+
+    def handle(self, path):
+        """Answer one request: returns (status, json body, headers)."""
+        throttled = self._throttled()
+        if self.latency:
+            tm.sleep(self.latency)
+        if throttled:
+            with self._lock:
+                self.errors += 1
+            return 429, dict(status = '429', message = 'Too Many Requests'), {'Retry-After': '1'}
+        if self.error_rate and self._random.random() < self.error_rate:
+            with self._lock:
+                self.errors += 1
+            return 503, None, {}
+
+        url = urlparse(path)
+        query = parse_qs(url.query)
+        parts = url.path[len(PREFIX):].strip('/').split('/', 1)
+        endpoint = parts[0]
+        if endpoint == 'data':
+            return self._page(query, *self._data(query))
+        records = dict(datasets = DATASETS, datacategories = DATACATEGORIES,
+                       datatypes = DATATYPES, locationcategories = LOCATIONCATEGORIES,
+                       locations = LOCATIONS, stations = self.stations).get(endpoint)
+        if records is None:
+            return 404, dict(status = '404', message = 'Not Found'), {}
+        if len(parts) == 2:
+            match = [record for record in records if record['id'] == parts[1]]
+            return (200, match[0], {}) if match else (404, {}, {})
+        if endpoint == 'stations':
+            records = self._filter_stations(records, query)
+        return self._page(query, len(records), records.__getitem__)
+
+    def _filter_stations(self, stations, query):
+        if 'startdate' in query:
+            stations = [s for s in stations if s['maxdate'] >= query['startdate'][0][:10]]
+        if 'enddate' in query:
+            stations = [s for s in stations if s['mindate'] <= query['enddate'][0][:10]]
+        if 'extent' in query:
+            south, west, north, east = map(float, query['extent'][0].split(','))
+            stations = [s for s in stations if south <= s['latitude'] <= north
+                        and west <= s['longitude'] <= east]
+        return stations
+
+    def _data(self, query):
+        """Row count and a row generator for a data query."""
+        dataset = query.get('datasetid', ['GHCND'])[0]
+        stations = query.get('stationid') or [s['id'] for s in self.stations]
+        datatypes = query.get('datatypeid') or [t['id'] for t in DATATYPES[:self.default_datatypes]]
+        start = dt.date.fromisoformat(query['startdate'][0][:10])
+        end = dt.date.fromisoformat(query['enddate'][0][:10])
+        step = STEP.get(dataset)
+        if step == 'month':
+            days = [dt.date(y, m, 1) for y in range(start.year, end.year + 1) for m in range(1, 13)
+                    if start <= dt.date(y, m, 1) <= end]
+        elif step == 'year':
+            days = [dt.date(y, 1, 1) for y in range(start.year, end.year + 1)
+                    if start <= dt.date(y, 1, 1) <= end]
+        else:
+            days = None
+        n_days = len(days) if days is not None else (end - start).days + 1
+        per_day = len(stations) * len(datatypes)
+
+        def row(i):
+            day, rest = divmod(i, per_day)
+            station, datatype = divmod(rest, len(datatypes))
+            date = days[day] if days is not None else start + dt.timedelta(days = day)
+            return dict(date = date.isoformat() + 'T00:00:00', datatype = datatypes[datatype],
+                        station = stations[station], attributes = ',,W,2400' if i % 7 else 'T,,W,',
+                        value = float((i * 37) % 400 - 100))
+
+        return max(0, n_days) * per_day, row
+
+    def _page(self, query, count, row):
+        if not count:
+            return 200, {}, {}
+        limit = min(int(query.get('limit', ['25'])[0]), self.max_limit)
+        offset = max(int(query.get('offset', ['1'])[0]), 1)
+        results = [row(i) for i in range(offset - 1, min(offset - 1 + limit, count))]
+        metadata = dict(resultset = dict(offset = offset, count = count, limit = limit))
+        return 200, dict(metadata = metadata, results = results), {}
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.strip().splitlines()[0])
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8000)
+    parser.add_argument('--latency', type = float, default = 0.0)
+    parser.add_argument('--error-rate', type = float, default = 0.0)
+    parser.add_argument('--rate-limit', type = int, default = None)
+    parser.add_argument('--stations', type = int, default = 1000)
+    args = parser.parse_args()
+    server = MockServer(args.host, args.port, latency = args.latency, error_rate = args.error_rate,
+                        rate_limit = args.rate_limit, n_stations = args.stations).start()
+    print(f'Serving {server.base_url}', flush = True)
+    try:
+        while True:
+            tm.sleep(3600)
+    except KeyboardInterrupt:
+        server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+"""
+Benchmark scenarios for Noaa against the local mock CDO server.
+
+Every scenario starts a mock_server.py process with its own latency,
+error rate, rate limit and page size settings, crawls it with
+collect_all and reports wall time, rows per second, peak Python memory
+(tracemalloc, client side only) and the requests used. Each scenario
+runs --repeat timed passes (the fastest is kept; the 1M row scenarios
+run once) and one pass under tracemalloc, so tracing overhead does not
+leak into the throughput numbers.
+
+    python benchmarks/run.py                     # default scenarios
+    python benchmarks/run.py --large             # adds the 1M row crawls
+    python benchmarks/run.py --only data_df      # one scenario
+    python benchmarks/run.py --save              # write baseline.json
+    python benchmarks/run.py --check             # exit 1 on regression
+
+--check compares against baseline.json: requests used must match
+exactly, rows/s may not drop and peak memory may not grow by more than
+--tolerance (default 25%). Baselines are machine specific; record one
+with --save on the machine that runs the gate.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import time as tm
+import tracemalloc
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+
+from NoaaWrapper import Noaa, RateLimiter, RetryPolicy, Metrics
+
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+
+def _stations(n):
+    return [f'GHCND:MOCK{i:07d}' for i in range(n)]
+
+
+# name: (server options, client options, call, large)
+SCENARIOS = dict(
+    stations_crawl = (dict(stations = 20000), dict(),
+                      lambda noaa: noaa.stations(limit = 1000, collect_all = True), False),
+    data_json = (dict(), dict(),
+                 lambda noaa: noaa.data('GHCND', '2020-01-01', '2020-12-31',
+                                        station_id = _stations(30), limit = 1000,
+                                        collect_all = True), False),
+    data_df = (dict(), dict(),
+               lambda noaa: noaa.data('GHCND', '2020-01-01', '2020-12-31',
+                                      station_id = _stations(30), limit = 1000,
+                                      collect_all = True, df = True), False),
+    data_stream = (dict(), dict(),
+                   lambda noaa: noaa.data('GHCND', '2020-01-01', '2020-12-31',
+                                          station_id = _stations(30), limit = 1000,
+                                          collect_all = True, stream = True), False),
+    data_small_pages = (dict(), dict(),
+                        lambda noaa: noaa.data('GHCND', '2020-01-01', '2020-03-31',
+                                               station_id = _stations(60), limit = 100,
+                                               collect_all = True, df = True), False),
+    data_windows_df = (dict(), dict(),
+                       lambda noaa: noaa.data('GSOM', '1990-01-01', '2019-12-31',
+                                              station_id = _stations(15), datatype_id = ['TMAX', 'TMIN'],
+                                              limit = 1000, collect_all = True, df = True), False),
+    data_flaky = (dict(latency = 0.05, error_rate = 0.05), dict(),
+                  lambda noaa: noaa.data('GHCND', '2020-01-01', '2020-06-30',
+                                         station_id = _stations(30), limit = 1000,
+                                         collect_all = True, df = True), False),
+    data_rate_limited = (dict(latency = 0.02, rate_limit = 5), dict(per_second = 5),
+                         lambda noaa: noaa.data('GHCND', '2020-01-01', '2020-03-31',
+                                                station_id = _stations(30), limit = 1000,
+                                                collect_all = True), False),
+    large_json = (dict(), dict(),
+                  lambda noaa: noaa.data('GHCND', '2020-01-01', '2021-05-14',
+                                         station_id = _stations(1000), limit = 1000,
+                                         collect_all = True), True),
+    large_df = (dict(), dict(),
+                lambda noaa: noaa.data('GHCND', '2020-01-01', '2021-05-14',
+                                       station_id = _stations(1000), limit = 1000,
+                                       collect_all = True, df = True), True),
+)
+
+
+@contextlib.contextmanager
+def mock_server(latency = 0.0, error_rate = 0.0, rate_limit = None, stations = 1000):
+    """Start mock_server.py in a child process and yield its base url."""
+    cmd = [sys.executable, os.path.join(HERE, 'mock_server.py'), '--port', '0',
+           '--latency', str(latency), '--error-rate', str(error_rate),
+           '--stations', str(stations)]
+    if rate_limit is not None:
+        cmd += ['--rate-limit', str(rate_limit)]
+    proc = subprocess.Popen(cmd, stdout = subprocess.PIPE, text = True)
+    try:
+        line = proc.stdout.readline()
+        yield line.split()[-1]
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def _rows(results):
+    if hasattr(results, '__next__'):
+        return sum(len(page) for page in results)
+    return len(results)
+
+
+def _client(base_url, per_second = 1000, max_workers = 5):
+    # The server enforces its own limits; the client's limiter only
+    # paces when a scenario asks it to.
+    return Noaa('benchmark', base_url = base_url, max_workers = max_workers,
+                rate_limiter = RateLimiter(per_second = per_second, per_day = 10 ** 9),
+                retry = RetryPolicy(max_retries = 5, backoff = 0.05), metrics = Metrics())
+
+
+def _once(base_url, client_options, call, trace):
+    with _client(base_url, **client_options) as noaa:
+        if trace:
+            tracemalloc.start()
+        start = tm.perf_counter()
+        with contextlib.redirect_stdout(io.StringIO()):
+            rows = _rows(call(noaa))
+        seconds = tm.perf_counter() - start
+        peak = None
+        if trace:
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        retries = sum(noaa.metrics.snapshot()['counters'].get('noaa_retries_total', {}).values())
+        used = noaa.rate_limiter.per_day - noaa.rate_limiter.remaining
+    return dict(rows = rows, seconds = seconds, peak = peak, requests = used - retries,
+                retries = retries)
+
+
+def run(name, memory = True, repeat = 3):
+    """Run a scenario, keeping the fastest of repeat timed passes."""
+    server_options, client_options, call, large = SCENARIOS[name]
+    with mock_server(**server_options) as base_url:
+        passes = [_once(base_url, client_options, call, trace = False)
+                  for _ in range(1 if large else repeat)]
+        result = min(passes, key = lambda result: result['seconds'])
+        if memory:
+            result['peak'] = _once(base_url, client_options, call, trace = True)['peak']
+    return dict(rows = result['rows'], seconds = round(result['seconds'], 3),
+                rows_per_s = round(result['rows'] / result['seconds'], 1),
+                peak_mb = None if result['peak'] is None else round(result['peak'] / 2 ** 20, 2),
+                requests = result['requests'], retries = result['retries'])
+
+
+def check(results, baseline, tolerance):
+    """Return a list of regression messages, empty if none."""
+    failures = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['requests'] != base['requests']:
+            failures.append(f'{name}: {result["requests"]} requests, baseline {base["requests"]}')
+        if result['rows'] != base['rows']:
+            failures.append(f'{name}: {result["rows"]} rows, baseline {base["rows"]}')
+        # Scenarios with injected errors or server side limits are too
+        # noisy to gate on speed.
+        if not SCENARIOS[name][0] and result['rows_per_s'] < base['rows_per_s'] * (1 - tolerance):
+            failures.append(f'{name}: {result["rows_per_s"]} rows/s, '
+                            f'baseline {base["rows_per_s"]}')
+        if result['peak_mb'] and base.get('peak_mb') and \
+           result['peak_mb'] > base['peak_mb'] * (1 + tolerance):
+            failures.append(f'{name}: {result["peak_mb"]} MB peak, baseline {base["peak_mb"]}')
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'Noaa benchmarks against a local mock server')
+    parser.add_argument('--only', nargs = '+', choices = sorted(SCENARIOS))
+    parser.add_argument('--large', action = 'store_true', help = 'include the 1M row scenarios')
+    parser.add_argument('--no-memory', action = 'store_true', help = 'skip the tracemalloc pass')
+    parser.add_argument('--save', action = 'store_true', help = f'write results to {BASELINE}')
+    parser.add_argument('--check', action = 'store_true', help = 'compare against the baseline')
+    parser.add_argument('--tolerance', type = float, default = 0.25)
+    parser.add_argument('--repeat', type = int, default = 3, 
+                        help = 'timed passes per scenario, the fastest is kept')
+    args = parser.parse_args()
+
+    names = args.only or [name for name, scenario in SCENARIOS.items()
+                          if args.large or not scenario[3]]
+    results = {}
+    print(f'{"scenario":<20}{"rows":>10}{"seconds":>10}{"rows/s":>12}'
+          f'{"peak MB":>10}{"requests":>10}{"retries":>9}')
+    for name in names:
+        result = results[name] = run(name, memory = not args.no_memory, repeat = args.repeat)
+        print(f'{name:<20}{result["rows"]:>10}{result["seconds"]:>10}{result["rows_per_s"]:>12}'
+              f'{str(result["peak_mb"]):>10}{result["requests"]:>10}{result["retries"]:>9}')
+
+    if args.save:
+        baseline = {}
+        if os.path.exists(BASELINE):
+            with open(BASELINE) as f:
+                baseline = json.load(f)
+        baseline.update(results)
+        with open(BASELINE, 'w') as f:
+            json.dump(baseline, f, indent = 2, sort_keys = True)
+    if args.check:
+        if not os.path.exists(BASELINE):
+            sys.exit(f'No baseline at {BASELINE}, record one with --save')
+        with open(BASELINE) as f:
+            failures = check(results, json.load(f), args.tolerance)
+        for failure in failures:
+            print('REGRESSION', failure)
+        sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,381 @@
+"""
+Bulk downloader for the NOAA CDO data endpoint, built on Noaa.
+
+    python noaa_fetch.py GHCND --stations-file stations.txt \\
+        --datatypes TMAX TMIN PRCP --start 1990-01-01 --end 2019-12-31 \\
+        --out ghcnd/ --format parquet
+
+The api token is read from --token or the NOAA_TOKEN environment
+variable. A pull is split into units, each a chained group of stations
+(or one location) over one date window, as in Noaa.data_batch().
+--workers units run at once under one rate limiter, and each unit's
+pages are written out as they arrive:
+
+    csv, ndjson     out/<dataset>/<start>_<end>_<unit>.csv|.ndjson
+    parquet         hive partitioned dataset under out/ (see ParquetSink)
+
+A unit's output is written under a temporary name and only moved into
+place once the unit is complete. Its pages are checkpointed as they
+arrive, and finished units are journaled in out/.noaa_fetch. Rerunning
+the same command therefore skips finished units and replays the
+checkpointed pages of interrupted ones without spending quota, so a
+cron job can simply be restarted. Requests made today are remembered
+per token in the same directory, and the run stops cleanly once the
+daily quota is used up.
+
+Throughput, requests, retries and the quota left are reported on
+stderr every --interval seconds (on one updating line on a terminal).
+Exit status is 0 when every unit is done, 1 if some failed and 3 if
+the quota ran out first; rerun to pick up the rest.
+"""
+import argparse
+import contextlib
+import csv
+import hashlib
+import json
+import os
+import shutil
+import sys
+import threading
+import time as tm
+from concurrent.futures import ThreadPoolExecutor
+
+from NoaaWrapper import Noaa, RateLimiter, Metrics, Checkpoint, ParquetSink, QuotaExceeded
+
+FORMATS = ('csv', 'ndjson', 'parquet')
+
+FIELDS = ['date', 'datatype', 'station', 'attributes', 'value']
+
+# Bookkeeping directory under the output; pyarrow skips dot directories
+STATE = '.noaa_fetch'
+
+
+def read_ids(ids, files):
+    """Station or location ids from the command line and from files, one per line."""
+    ids = list(ids or [])
+    for name in files or []:
+        with (contextlib.nullcontext(sys.stdin) if name == '-' else open(name)) as f:
+            for line in f:
+                # Also takes the first column of a csv, e.g. a stations() export
+                value = line.split('#', 1)[0].split(',', 1)[0].strip().strip('"')
+                if value and value != 'id':
+                    ids.append(value)
+    # Keep the order, drop repeats
+    return list(dict.fromkeys(ids))
+
+
+class Unit(object):
+
+    def __init__(self, dataset_id, start_date, end_date, station_id = None,
+                 location_id = None, datatype_id = None, units = None):
+        """One data() call of the pull, identified by key across runs."""
+        self.call = dict(dataset_id = dataset_id, start_date = start_date, end_date = end_date,
+                         station_id = station_id, location_id = location_id,
+                         datatype_id = datatype_id, units = units)
+        self.key = hashlib.sha1(json.dumps(self.call, sort_keys = True).encode()).hexdigest()[:16]
+
+    def path(self, out, fmt):
+        call = self.call
+        return os.path.join(out, call['dataset_id'],
+                            f"{call['start_date'][:10]}_{call['end_date'][:10]}_{self.key}.{fmt}")
+
+
+def plan(noaa, datasets, start_date, end_date, station_ids = None, location_ids = None,
+         datatype_ids = None, units = None):
+    """Every Unit of the pull, in dataset, window, group order."""
+    work = []
+    for dataset_id in datasets:
+        windows = noaa._date_windows(dataset_id, start_date, end_date)
+        groups = [dict(station_id = group) for group in
+                  noaa._plan_batch(dataset_id, station_ids or [], start_date, end_date,
+                                   datatype_ids)]
+        groups += [dict(location_id = location_id) for location_id in location_ids or []]
+        work += [Unit(dataset_id, start, end, datatype_id = datatype_ids, units = units, **group)
+                 for start, end in windows for group in groups]
+    return work
+
+
+class TextOutput(object):
+
+    def __init__(self, path, fmt):
+        """csv or ndjson file of one unit, written to path.part until commit()."""
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        self.path = path
+        self.tmp = path + '.part'
+        self.file = open(self.tmp, 'w', newline = '')
+        if fmt == 'csv':
+            writer = csv.DictWriter(self.file, FIELDS, extrasaction = 'ignore')
+            writer.writeheader()
+            self._write = writer.writerows
+        else:
+            self._write = lambda results: self.file.writelines(
+                json.dumps(record, separators = (',', ':')) + '\n' for record in results)
+
+    def write(self, results):
+        self._write(results)
+
+    def commit(self):
+        self.file.close()
+        os.replace(self.tmp, self.path)
+
+    def abort(self):
+        self.file.close()
+        os.remove(self.tmp)
+
+
+class ParquetOutput(object):
+
+    def __init__(self, out, staging, dataset_id):
+        """
+        Parquet files of one unit, written under staging and moved into
+        the dataset at out on commit().
+        """
+        self.out = out
+        self.staging = staging
+        shutil.rmtree(staging, ignore_errors = True)
+        self.sink = ParquetSink(staging, kind = 'data', dataset_id = dataset_id)
+
+    def write(self, results):
+        self.sink.write(results)
+
+    def commit(self):
+        self.sink.close()
+        for path in self.sink.files:
+            target = os.path.join(self.out, os.path.relpath(path, self.staging))
+            os.makedirs(os.path.dirname(target), exist_ok = True)
+            os.replace(path, target)
+        shutil.rmtree(self.staging, ignore_errors = True)
+
+    def abort(self):
+        self.sink.close()
+        shutil.rmtree(self.staging, ignore_errors = True)
+
+
+class Stats(object):
+
+    def __init__(self, units, skipped):
+        """Live counts of a pull, fed by a Metrics callback and the workers."""
+        self.units = units
+        self.skipped = skipped
+        self.done = 0
+        self.failed = 0
+        self.rows = 0
+        self.requests = 0
+        self.replayed = 0
+        self.retries = 0
+        self.bytes = 0
+        self.quota_remaining = None
+        self.started = tm.perf_counter()
+        self._lock = threading.Lock()
+
+    def record(self, event):
+        with self._lock:
+            if event['cache'] == 'checkpoint':
+                self.replayed += 1
+            elif event['cache'] not in ('hit', 'coalesced') and \
+                 event.get('error') != 'QuotaExceeded':
+                self.requests += 1
+                self.retries += event['retries']
+                self.bytes += event['bytes'] or 0
+            self.quota_remaining = event['quota_remaining']
+
+    def add(self, rows = 0, done = 0, failed = 0):
+        with self._lock:
+            self.rows += rows
+            self.done += done
+            self.failed += failed
+
+    def line(self):
+        seconds = max(tm.perf_counter() - self.started, 1e-9)
+        return (f'{self.skipped + self.done}/{self.units} units | {self.failed} failed | '
+                f'{self.rows} rows | {self.rows / seconds:.0f} rows/s | '
+                f'{self.requests} requests ({self.requests / seconds:.1f}/s) | '
+                f'{self.retries} retries | {self.replayed} replayed | '
+                f'{self.bytes / 2 ** 20 / seconds:.2f} MB/s | quota left {self.quota_remaining}')
+
+
+def report(stats, interval, stop):
+    """Print stats.line() to stderr until stop is set."""
+    tty = sys.stderr.isatty()
+    while not stop.wait(1 if tty else interval):
+        if tty:
+            print('\r' + stats.line(), end = '', file = sys.stderr, flush = True)
+        else:
+            print(stats.line(), file = sys.stderr, flush = True)
+
+
+class QuotaFile(object):
+
+    def __init__(self, path, api_key):
+        """Requests made today (UTC) with one token, kept across runs."""
+        self.path = path
+        self.token = hashlib.sha1(api_key.encode()).hexdigest()[:12]
+        self.day = tm.strftime('%Y-%m-%d', tm.gmtime())
+
+    def used(self):
+        try:
+            with open(self.path) as f:
+                state = json.load(f).get(self.token, {})
+        except (FileNotFoundError, ValueError):
+            return 0
+        return state.get('used', 0) if state.get('day') == self.day else 0
+
+    def add(self, requests):
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (FileNotFoundError, ValueError):
+            state = {}
+        state[self.token] = dict(day = self.day, used = self.used() + requests)
+        with open(self.path + '.tmp', 'w') as f:
+            json.dump(state, f)
+        os.replace(self.path + '.tmp', self.path)
+
+
+def fetch(noaa, unit, args, state, stats):
+    """Stream one unit into its output and return the rows written."""
+    checkpoint = Checkpoint(unit.key, directory = os.path.join(state, 'checkpoints'))
+    if args.format == 'parquet':
+        output = ParquetOutput(args.out, os.path.join(state, 'staging', unit.key),
+                               unit.call['dataset_id'])
+    else:
+        output = TextOutput(unit.path(args.out, args.format), args.format)
+    rows = 0
+    try:
+        for results in noaa.data(**unit.call, collect_all = True, stream = True,
+                                 checkpoint = checkpoint, progress = False):
+            output.write(results)
+            rows += len(results)
+            stats.add(rows = len(results))
+    except BaseException:
+        output.abort()
+        raise
+    output.commit()
+    checkpoint.clear()
+    return rows
+
+
+def run(args):
+    """Run the pull described by args and return the exit status."""
+    stations = read_ids(args.stations, args.stations_file)
+    locations = read_ids(args.locations, args.locations_file)
+    if not stations and not locations:
+        sys.exit('noaa_fetch: give --stations, --stations-file, --locations or --locations-file')
+    token = args.token or os.environ.get('NOAA_TOKEN')
+    if not token:
+        sys.exit('noaa_fetch: no api token, pass --token or set NOAA_TOKEN')
+
+    state = os.path.join(args.out, STATE)
+    os.makedirs(state, exist_ok = True)
+    quota = QuotaFile(os.path.join(state, 'quota.json'), token)
+    used = quota.used()
+    limiter = RateLimiter(per_second = args.per_second, per_day = max(args.per_day - used, 0))
+    budget = limiter.remaining
+    metrics = Metrics()
+    # Units run --workers at a time and each fetches its pages in turn, 
+    # so no more requests are in flight than there are pooled connections
+    noaa = Noaa(token, base_url = args.base_url, max_workers = 1,
+                pool_size = max(args.workers, 1), max_retries = args.retries,
+                rate_limiter = limiter, metrics = metrics)
+
+    with noaa:
+        work = plan(noaa, args.datasets, args.start, args.end, stations, locations,
+                    args.datatypes, args.units)
+        journal_path = os.path.join(state, 'journal')
+        try:
+            with open(journal_path) as f:
+                finished = set(line.strip() for line in f)
+        except FileNotFoundError:
+            finished = set()
+        todo = [unit for unit in work if unit.key not in finished]
+        stats = Stats(len(work), len(work) - len(todo))
+        metrics.callbacks.append(stats.record)
+        stats.quota_remaining = limiter.remaining
+
+        halt = threading.Event()
+        lock = threading.Lock()
+        errors = []
+
+        def work_on(unit):
+            if halt.is_set():
+                return
+            try:
+                fetch(noaa, unit, args, state, stats)
+            except QuotaExceeded:
+                halt.set()
+                return
+            except Exception as e:
+                stats.add(failed = 1)
+                errors.append((unit, e))
+                return
+            with lock:
+                journal.write(unit.key + '\n')
+                journal.flush()
+            stats.add(done = 1)
+
+        stop = threading.Event()
+        reporter = None
+        if not args.quiet:
+            reporter = threading.Thread(target = report, args = (stats, args.interval, stop),
+                                        daemon = True)
+            reporter.start()
+        with open(journal_path, 'a') as journal:
+            pool = ThreadPoolExecutor(max(1, args.workers))
+            try:
+                list(pool.map(work_on, todo))
+            except KeyboardInterrupt:
+                # Let the running units finish, start no new ones
+                halt.set()
+            finally:
+                pool.shutdown(wait = True)
+                stop.set()
+                quota.add(budget - limiter.remaining)
+        if reporter is not None:
+            reporter.join()
+            print(('\r' if sys.stderr.isatty() else '') + stats.line(), file = sys.stderr)
+
+    for unit, error in errors:
+        call = unit.call
+        print(f"noaa_fetch: unit {unit.key} ({call['dataset_id']} {call['start_date']} "
+              f"{call['end_date']}) failed: {error!r}", file = sys.stderr)
+    if halt.is_set() and stats.skipped + stats.done + stats.failed < stats.units:
+        print('noaa_fetch: stopped before every unit was fetched (daily quota used up or '
+              'interrupted); rerun to continue', file = sys.stderr)
+        return 3
+    return 1 if errors else 0
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(
+        prog = 'noaa_fetch', description = __doc__.strip().splitlines()[0])
+    parser.add_argument('datasets', nargs = '+', metavar = 'dataset',
+                        help = 'dataset ids, e.g. GHCND GSOM')
+    parser.add_argument('--stations', nargs = '+', metavar = 'ID', help = 'station ids')
+    parser.add_argument('--stations-file', nargs = '+', metavar = 'FILE',
+                        help = "files of station ids, one per line or in a csv's first column "
+                               "('-' reads stdin)")
+    parser.add_argument('--locations', nargs = '+', metavar = 'ID',
+                        help = 'location ids, e.g. FIPS:37, fetched one per request')
+    parser.add_argument('--locations-file', nargs = '+', metavar = 'FILE')
+    parser.add_argument('--datatypes', nargs = '+', metavar = 'ID',
+                        help = 'data type ids; all of them if not given')
+    parser.add_argument('--start', required = True, help = 'first date, YYYY-MM-DD')
+    parser.add_argument('--end', required = True, help = 'last date, YYYY-MM-DD')
+    parser.add_argument('--units', choices = ('standard', 'metric'))
+    parser.add_argument('--out', required = True, help = 'output directory')
+    parser.add_argument('--format', choices = FORMATS, default = 'csv')
+    parser.add_argument('--token', help = 'api token, defaults to $NOAA_TOKEN')
+    parser.add_argument('--workers', type = int, default = 5, help = 'units fetched at once')
+    parser.add_argument('--per-second', type = float, default = 5, help = 'requests per second')
+    parser.add_argument('--per-day', type = int, default = 10000,
+                        help = "the token's daily quota; today's earlier runs count against it")
+    parser.add_argument('--retries', type = int, default = 3)
+    parser.add_argument('--base-url', help = 'api root, for a proxy or a mock server')
+    parser.add_argument('--interval', type = float, default = 10,
+                        help = 'seconds between reports when stderr is not a terminal')
+    parser.add_argument('--quiet', action = 'store_true', help = 'no progress reports')
+    return run(parser.parse_args(argv))
+
+
+if __name__ == '__main__':
+    sys.exit(main())